@@ -54,7 +54,7 @@ namespace IT2AMK
 				verbose_enabled = true;
 				debug_enabled = true;
 
-				write_sysinfo();
+				Directory.CreateDirectory(G.TEMP_PATH);
 				clear_temp_folder();
 
 				string folder_name = it_file.Split('.')[0];
@@ -72,8 +72,6 @@ namespace IT2AMK
 				var it = new IT.Module(it_file);
 				IT.Sample prepared;
 
-				string tuning_str = "";
-
 				for (int i = 0; i < it.samples.Count; i++) {
 					if (it.samples[i].has_sample && (i >= use_flags.Count || use_flags[i])) {
 						it.samples[i].trim();
@@ -91,12 +89,11 @@ namespace IT2AMK
 						}
 
 						string fname = (i + 1).ToString().PadLeft(2, '0') + " " + format_filename(prepared.name) + ".brr";
-						tuning_str += "\"" + fname + "\" $" + int_to_hex(iround((double)prepared.c5_speed * 768 / 12539), 4) + "\n";
+						// Tunings go to stdout, one per line, for it2amk.py to pick out of the log
+						Console.WriteLine("tuning \"" + fname + "\" $" + int_to_hex(iround((double)prepared.c5_speed * 768 / 12539), 4));
 					}
 				}
 
-				File.WriteAllText(G.TEMP_PATH + "tunings.txt", tuning_str);
-
 			} catch (FileNotFoundException e) {
 				show_error(e.Message);
 				error = true;
@@ -120,6 +117,12 @@ namespace IT2AMK
 				error = true;
 			}
 
+			try {
+				Directory.Delete(G.TEMP_PATH, true);
+			} catch (IOException) {
+			} catch (UnauthorizedAccessException) {
+			}
+
 			if (!error) {
 				stopwatch.Stop();
 				//Console.WriteLine("Done! {0} ms", stopwatch.ElapsedMilliseconds);
@@ -143,19 +146,5 @@ namespace IT2AMK
 				file.Delete(); 
 			}
 		}
-
-		public static void write_sysinfo()
-		{
-			string[] lines = {
-				string.Format("{0} {1}", "RAM".PadRight(14, ' '), Util.CPU.get_total_memory()),
-				string.Format("{0} {1}", "OS".PadRight(14, ' '), Util.CPU.get_os()),
-				string.Format("{0} {1} ({2})", "Processor".PadRight(14, ' '), Util.CPU.get_processor_name(),
-							  Util.CPU.get_os_bits()),
-				string.Format("{0} {1} ({2})", "Architecture".PadRight(14, ' '), Util.CPU.get_architecture(),
-							  Util.CPU.get_endianness())
-			};
-
-			File.WriteAllLines("sysinfo.txt", lines);
-		}
 	}
 }
@@ -1,5 +1,7 @@
 ﻿using System;
 using System.Collections.Generic;
+using System.Diagnostics;
+using System.IO;
 using System.Linq;
 using System.Text;
 using System.Threading.Tasks;
@@ -8,7 +10,8 @@ namespace IT2AMK
 {
 	class Global
 	{
-		public const string TEMP_PATH = "temp/";
+		// Per-process scratch folder for brr_encoder.exe, so conversions never share temp files
+		public static readonly string TEMP_PATH = Path.Combine(Path.GetTempPath(), "it2amk-" + Process.GetCurrentProcess().Id) + "/";
 		public const string DEFAULT_SAMPLES_PATH = "samples/";
 		public const string AMK_SAMPLES_PATH = "samples/"; // Todo: change this later
 	}
@@ -0,0 +1,76 @@
+"""
+ARAM budget planning: pick per-sample resample ratios so the converted BRRs fit in a byte budget.
+
+BRR size only depends on the sample length (9 bytes per 16 samples, plus a silent first block and
+the AMK loop header), and the length after resampling only on the length, loop and ratio, so the
+sizes can be projected from the IT samples before converting anything.
+"""
+
+min_fraction = 0.1 # No ratio is lowered below this fraction of its normal value
+
+def source_length(it_sample, max_length=None):
+	# (length, loop start or None if it isn't looped) after trimming to the loop end, expanding a
+	# ping-pong loop and truncating to max_length, like sampconv does
+	length = int(it_sample.sampleDataLen()) if it_sample.IsSample else 0
+	if length == 0:
+		return 16, None
+	begin, end = it_sample.LoopBegin, it_sample.LoopEnd
+	looped = it_sample.IsLooped and begin < end <= length
+	if looped:
+		length = end
+		if it_sample.IsPingPongLoop and end - 2 > begin:
+			length += end - 2 - begin
+	if max_length is not None and max_length < length and not (looped and max_length >= begin):
+		return max_length, None
+	return length, begin if looped else None
+
+def projected_size(length, loop_start, ratio):
+	# The size sampconv.prepare_sample() and sample_to_brr() give a sample of length frames, going
+	# through the same loop stretching or repeating. Errs on the large side: the silent first block
+	# is assumed, and unlooped samples may get a block too many.
+	import resampler # Only the native encoder needs numpy
+	length, loop_start = resampler.resampled_length(length, loop_start, length * ratio)
+	if loop_start is not None and loop_start % 16 != 0:
+		# prepare_sample() resamples once more at the same length to line the loop start up
+		length, loop_start = resampler.resampled_length(length, loop_start, length)
+	return 2 + 9 + 9 * (length // 16)
+
+def solve_ratios(lengths, weights, max_ratios, budget):
+	"""
+	Resample ratios for samples of the given (length, loop start) whose projected sizes fit in budget
+	bytes. The quality loss of a sample is weight * log(max_ratio / ratio), i.e. octaves of bandwidth
+	lost, counted more for samples that are used more. Since size grows with length * ratio, the least total loss comes from
+	ratio = weight / (k * length) for some k, clamped to [min_fraction * max_ratio, max_ratio]; k is
+	found by bisection. If the samples don't fit even then, every ratio is min_fraction * max_ratio.
+	"""
+	def ratios(k):
+		return [min(max(w / (k * l[0]), m * min_fraction), m) for l, w, m in zip(lengths, weights, max_ratios)]
+
+	def total(rs):
+		return sum(projected_size(l[0], l[1], r) for l, r in zip(lengths, rs))
+
+	if total(max_ratios) <= budget:
+		return list(max_ratios)
+	if total(ratios(float('inf'))) > budget:
+		return ratios(float('inf'))
+
+	lo, hi = -60.0, 60.0 # log2 of k
+	for i in range(0, 100):
+		mid = (lo + hi) / 2
+		if total(ratios(2.0 ** mid)) > budget:
+			lo = mid
+		else:
+			hi = mid
+	return ratios(2.0 ** hi)
+
+def format_report(budget, rows):
+	# rows are (sample number, (length, loop start), uses, old ratio, new ratio)
+	old_total = sum(projected_size(r[1][0], r[1][1], r[3]) for r in rows)
+	new_total = sum(projected_size(r[1][0], r[1][1], r[4]) for r in rows)
+	lines = ['ARAM budget: ' + str(budget) + ' bytes, projected ' + str(new_total) + ' bytes (was ' + str(old_total) + ')']
+	if new_total > budget:
+		lines.append('The budget can\'t be reached: every sample is already at ' + str(min_fraction) + ' of its normal ratio.')
+	lines.append('  Sample   Length  Uses   Ratio    Bytes')
+	for s, length, uses, old_ratio, new_ratio in rows:
+		lines.append('  %6d %8d %5d %7.3f %8d' % (s, length[0], uses, new_ratio, projected_size(length[0], length[1], new_ratio)))
+	return '\n'.join(lines)
@@ -0,0 +1,62 @@
+# Benchmark for brr.encode: the default exact search, fast and beam vs. a full per-block scalar search
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import brr
+
+def encode_scan(pcm):
+	# Try all 4 filters x 13 shifts for every block, one candidate at a time
+	data = bytearray()
+	if brr.initial_block_needed(pcm):
+		data += brr.pack_block(0, 0, [0] * brr.BLOCK_SAMPLES)
+	p1, p2 = 0, 0
+	for b in range(0, len(pcm) // brr.BLOCK_SAMPLES):
+		block = [s >> 1 for s in pcm[b * brr.BLOCK_SAMPLES:(b + 1) * brr.BLOCK_SAMPLES]]
+		best = None
+		for filter in range(0, 4):
+			for shift in range(0, 13):
+				result = brr.encode_block(block, filter, shift, p1, p2)
+				if best is None or result[0] < best[0]:
+					best = result + (filter, shift)
+		error, nibbles, p1, p2, filter, shift = best
+		data += brr.pack_block(filter, shift, nibbles, False, b == len(pcm) // brr.BLOCK_SAMPLES - 1)
+	return bytes(data)
+
+def snr(pcm, data):
+	decoded = np.array(brr.decode(data)[-len(pcm):], dtype=np.float64)
+	source = np.array(pcm, dtype=np.float64)
+	noise = ((source - decoded) ** 2).sum()
+	return 10 * math.log10((source ** 2).sum() / noise) if noise > 0 else float('inf')
+
+def signals(length):
+	rng = np.random.default_rng(1)
+	t = np.arange(0, length)
+	yield 'sine', np.sin(t * 2 * np.pi / 100) * 20000
+	yield 'decaying chord', (np.sin(t * 0.031) + np.sin(t * 0.047) + np.sin(t * 0.113)) * 9000 * np.exp(-t / length * 3)
+	yield 'noise', rng.normal(size=length) * 6000
+
+def main():
+	length = 16384
+	for name, signal in signals(length):
+		pcm = [int(s) for s in np.clip(np.round(signal), -0x8000, 0x7FFF)]
+		print('%s, %d samples' % (name, length))
+
+		start = time.perf_counter()
+		data = encode_scan(pcm)
+		t_scan = time.perf_counter() - start
+		print('    scan:    %7.3f s  %6.2f dB' % (t_scan, snr(pcm, data)))
+
+		for label, beam, fast in (('exact', 1, False), ('fast', 1, True), ('beam 4', 4, False)):
+			start = time.perf_counter()
+			data = brr.encode(pcm, None, beam, fast)[0]
+			t = time.perf_counter() - start
+			print('    %-7s  %7.3f s  %6.2f dB  (%.1fx)' % (label + ':', t, snr(pcm, data), t_scan / t))
+
+if __name__ == '__main__':
+	main()
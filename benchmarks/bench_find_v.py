@@ -0,0 +1,49 @@
+# Microbenchmark for MML.find_v: table lookup vs. the old linear scan over all 256 v values
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import it2amk
+
+def find_v_scan(level):
+	if level == 0:
+		return 0
+		
+	mindiff = 256
+	minval = -1
+	
+	for v in range(0, 256):
+		vv = (v * 0xFF) >> 8
+		vv = (vv * vv) >> 8
+		vv = (vv * 0x51) >> 8
+		vv = (vv * 0xFC) >> 8
+		l = vv * 0xFF / 0x4D
+		
+		if abs(l - level) <= mindiff:
+			mindiff = abs(l - level)
+			minval = v
+			
+	return minval
+	
+def main():
+	mml = it2amk.MML.__new__(it2amk.MML) # find_v doesn't need an event table
+	
+	levels = list(range(-300, 600)) + [x / 8.0 for x in range(-80, 2200)]
+	for level in levels:
+		if mml.find_v(level) != find_v_scan(level):
+			print('Mismatch at level', level, ':', mml.find_v(level), '!=', find_v_scan(level))
+			sys.exit(1)
+			
+	n = 200
+	ints = list(range(0, 256))
+	t_scan = timeit.timeit(lambda: [find_v_scan(l) for l in ints], number=n)
+	t_table = timeit.timeit(lambda: [mml.find_v(l) for l in ints], number=n)
+	per_call = 1e6 / (n * len(ints))
+	print('find_v, %d calls' % (n * len(ints)))
+	print('    scan:  %8.3f us/call' % (t_scan * per_call))
+	print('    table: %8.3f us/call  (%.0fx)' % (t_table * per_call, t_scan / t_table))
+	
+if __name__ == '__main__':
+	main()
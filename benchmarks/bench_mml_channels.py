@@ -0,0 +1,51 @@
+# Benchmark for MML generation: serial channels vs. the cjobs process pool
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pyIT
+import it2amk
+from stubs import StubEventTable
+
+def load_module(path, repeat):
+	# example3 uses channels 1-7; copy channel 1 into channel 8 and repeat the order list to make a longer song
+	it = pyIT.ITfile()
+	it.open(path)
+	for p in it.Patterns:
+		for r in p.Rows:
+			r[7] = copy.copy(r[0])
+	orders = [o for o in it.Orders if o <= 199]
+	it.Orders = orders * repeat + [255]
+	return it
+	
+def run(it, config, path, jobs):
+	config.flags['cjobs'][0] = jobs
+	evtbl = StubEventTable(it, config, path)
+	t = time.perf_counter()
+	mml = it2amk.MML(evtbl)
+	return time.perf_counter() - t, mml.txt
+	
+def main():
+	path = sys.argv[1] if len(sys.argv) > 1 else 'modules/example3.it'
+	repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+	
+	it = load_module(path, repeat)
+	config = it2amk.Config()
+	config.get_module_flags(it)
+	
+	t_serial, txt_serial = run(it, config, path, 1)
+	print('%s x%d, %d bytes of MML' % (path, repeat, len(txt_serial)))
+	print('    serial:    %8.3f s' % t_serial)
+	for jobs in (2, 4, 8):
+		it = load_module(path, repeat)
+		t, txt = run(it, config, path, jobs)
+		if txt != txt_serial:
+			print('Mismatch between serial and cjobs=%d output' % jobs)
+			sys.exit(1)
+		print('    cjobs=%d:   %8.3f s  (%.2fx)' % (jobs, t, t_serial / t))
+		
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,65 @@
+# Benchmark for the resamplers: vectorized NumPy vs. a point-at-a-time loop like resampler.cs
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import resampler
+import sampconv
+
+def resample_loop(rs, sample, new_length):
+	# Unlooped resampling one output point at a time, interpolating like resampler.cs
+	multiplier = sample.length / new_length
+	out = []
+	stepper = 0.0
+	while stepper < sample.length:
+		f = math.floor(stepper)
+		frac = stepper - f
+		indexes = [min(t + f, sample.length - 1) for t in rs.taps]
+		if isinstance(rs, resampler.SincResampler):
+			total = 0.0
+			for t, i in zip(rs.taps, indexes):
+				if i >= 0:
+					total += sample.data[i, 0] * np.sinc(frac - t)
+			out.append(math.floor(total + 0.5))
+		elif isinstance(rs, resampler.CubicResampler):
+			p = [float(sample.data[max(i, 0), 0]) for i in indexes]
+			u = frac
+			out.append(math.floor(((u*u*(2-u)-u)*p[0] + (u*u*(3*u-5)+2)*p[1] + (u*u*(4-3*u)+u)*p[2] + u*u*(u-1)*p[3])/2 + 0.5))
+		elif isinstance(rs, resampler.LinearResampler):
+			p = [float(sample.data[max(i, 0), 0]) for i in indexes]
+			out.append(math.floor((1 - frac) * p[0] + frac * p[1] + 0.5))
+		else:
+			out.append(int(sample.data[max(indexes[0 if frac < 0.5 else 1], 0), 0]))
+		stepper += multiplier
+	return np.array(out, dtype=np.int64)
+
+def main():
+	length = 4096
+	sample = sampconv.Sample()
+	t = np.arange(0, length)
+	sample.data = np.round((np.sin(t * 0.05) + np.sin(t * 0.41) * 0.3) * 20000).astype(np.int64).reshape(-1, 1)
+
+	for name in ('nearest', 'linear', 'cubic', 'sinc'):
+		rs = resampler.get_resampler(name)
+		start = time.perf_counter()
+		expected = resample_loop(rs, sample, length * 0.5)
+		t_loop = time.perf_counter() - start
+
+		start = time.perf_counter()
+		data = rs.resample(sample.copy(), length * 0.5).data[:len(expected), 0]
+		t_vector = time.perf_counter() - start
+
+		if not (data == expected).all():
+			print(name + ': vectorized output differs from the loop')
+			sys.exit(1)
+		print('%-8s %d samples at 0.5' % (name, length))
+		print('    loop:       %8.3f s' % t_loop)
+		print('    vectorized: %8.3f s  (%.0fx)' % (t_vector, t_loop / t_vector))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,32 @@
+# Benchmark for sampconv.convert_samples: serial vs. one process per CPU core, over every sample of a module
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pyIT
+import sampconv
+
+def main():
+	path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules', 'example2.it')
+	module = pyIT.ITfile()
+	module.open(path)
+
+	used = set(s + 1 for s in range(0, len(module.Samples)) if module.Samples[s].IsSample)
+	ratios = [1.0] * len(module.Samples)
+	amplify = [0.92] * len(module.Samples)
+	print('%s, %d samples, %d CPUs' % (os.path.basename(path), len(used), os.cpu_count() or 1))
+
+	results = {}
+	for jobs in (1, 0):
+		start = time.perf_counter()
+		results[jobs] = sampconv.convert_samples(module, used, ratios, amplify, True, 1, jobs)
+		print('    jobs %d: %7.3f s' % (jobs, time.perf_counter() - start))
+
+	if [p.brr_data for p in results[1]] != [p.brr_data for p in results[0]]:
+		print('Parallel output differs from serial output')
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
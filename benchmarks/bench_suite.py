@@ -0,0 +1,131 @@
+# Benchmark suite: times each conversion stage over the example modules and synthetic stress modules,
+# and compares the times against a saved baseline.
+#
+#     python benchmarks/bench_suite.py [--samples stub|native] [--repeat n] [--scale n]
+#                                      [--baseline file] [--save true] [--threshold 0.25]
+#
+# Stages are open (ITfile.open), events (EventTable, with the sample stage stubbed), samples (the native
+# encoder, only with --samples native) and mml (MML). Each is the fastest of --repeat runs, with the ADSR
+# caches cleared before each, so it's what a fresh process pays. Without a baseline file, or with
+# --save true, the times are saved as the new baseline. Otherwise the exit code is 1 if any stage got
+# more than --threshold (0.25 = 25%) slower than in the baseline; slowdowns under 10 ms are ignored.
+# The stress modules are written by itgen.py to a temporary folder first.
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pyIT
+import it2amk
+import itgen
+from stubs import StubEventTable
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+noise_floor = 0.01 # Slowdowns smaller than this many seconds are noise
+
+stress_modules = {
+	# itgen.write_module() arguments for each stress module at --scale n
+	'stress-patterns' : lambda n: { 'seed' : 1, 'patterns' : min(200, 100 * n), 'orders' : min(255, 100 * n) },
+	'stress-channels' : lambda n: { 'seed' : 2, 'patterns' : min(200, 16 * n), 'channels' : 64, 'effects' : 0.15 },
+	'stress-loops' : lambda n: { 'seed' : 3, 'patterns' : 40, 'orders' : min(255, 50 * n), 'loops' : 1.0 },
+	'stress-samples' : lambda n: { 'seed' : 4, 'patterns' : 4, 'instruments' : 8, 'sample_length' : 65536 * n, 'compressed' : True },
+	'stress-envelopes' : lambda n: { 'seed' : 5, 'patterns' : min(200, 8 * n), 'instruments' : 99, 'nodes' : 25 }
+}
+
+def get_cases(scale, folder):
+	# (name, module file), writing the stress modules to folder
+	cases = []
+	for n in range(1, 5):
+		cases.append(('example%d' % n, os.path.join(root, 'modules', 'example%d.it' % n)))
+	for name, options in stress_modules.items():
+		path = os.path.join(folder, name + '.it')
+		itgen.write_module(path, **options(scale))
+		cases.append((name, path))
+	return cases
+
+def run_case(path, samples):
+	# Returns {stage: seconds} for one conversion
+	it2amk.adsr_fits.clear()
+	it2amk.adsr_caches.clear()
+	times = {}
+	start = time.perf_counter()
+	it = pyIT.ITfile()
+	it.open(path)
+	times['open'] = time.perf_counter() - start
+
+	config = it2amk.Config()
+	config.get_module_flags(it)
+	for flag, value in (('cachesize', '0'), ('sjobs', '1'), ('cjobs', '1'), ('encoder', 'native')):
+		config.set_flag(flag, value)
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		start = time.perf_counter()
+		evtbl = StubEventTable(it, config, 'bench', False)
+		evtbl.sample_dict # Wait for the stub
+		times['events'] = time.perf_counter() - start
+
+		if samples == 'native':
+			start = time.perf_counter()
+			evtbl.sample_dict = it2amk.EventTable.get_sample_tunings(evtbl, evtbl.unused_samples, evtbl.max_lengths)
+			times['samples'] = time.perf_counter() - start
+
+		start = time.perf_counter()
+		it2amk.MML(evtbl)
+		times['mml'] = time.perf_counter() - start
+	return times
+
+def main():
+	options = { 'samples' : 'stub', 'repeat' : '3', 'scale' : '1', 'baseline' : os.path.join(root, 'benchmarks', 'baseline.json'),
+	            'save' : 'false', 'threshold' : '0.25' }
+	args = sys.argv[1:]
+	if len(args) % 2 != 0 or any(not a.startswith('--') or a[2:] not in options for a in args[::2]):
+		print('Usage: python benchmarks/bench_suite.py [--samples stub|native] [--repeat n] [--scale n] [--baseline file] [--save true] [--threshold 0.25]')
+		sys.exit(1)
+	for i in range(0, len(args), 2):
+		options[args[i][2:]] = args[i + 1]
+	repeat, scale, threshold = int(options['repeat']), int(options['scale']), float(options['threshold'])
+
+	results = {}
+	print('%-18s %10s %10s %10s %10s' % ('Module', 'open', 'events', 'samples', 'mml'))
+	with tempfile.TemporaryDirectory() as folder:
+		for name, path in get_cases(scale, folder):
+			best = {}
+			for i in range(repeat):
+				for stage, t in run_case(path, options['samples']).items():
+					best[stage] = min(best.get(stage, t), t)
+			results[name] = best
+			print('%-18s' % name + ''.join(' %10.3f' % best[s] if s in best else '          -' for s in ('open', 'events', 'samples', 'mml')))
+
+	baseline = None
+	if os.path.exists(options['baseline']) and options['save'].lower() != 'true':
+		with open(options['baseline'], 'r') as file:
+			baseline = json.load(file)
+	if baseline is not None and (baseline.get('samples') != options['samples'] or baseline.get('scale') != scale):
+		print('The baseline was made with --samples ' + str(baseline.get('samples')) + ' --scale ' + str(baseline.get('scale')) + '; use those or --save true.')
+		sys.exit(1)
+	if baseline is None:
+		with open(options['baseline'], 'w') as file:
+			json.dump({ 'samples' : options['samples'], 'scale' : scale, 'results' : results }, file, indent=4)
+		print('Saved the baseline to ' + options['baseline'] + '.')
+		return
+
+	regressions = []
+	for name, stages in results.items():
+		for stage, t in stages.items():
+			old = baseline['results'].get(name, {}).get(stage)
+			if old is not None and t > old * (1 + threshold) and t - old > noise_floor:
+				regressions.append('%s %s: %.3f s, was %.3f s (+%.0f%%)' % (name, stage, t, old, (t / old - 1) * 100))
+	if len(regressions) > 0:
+		print('Slower than the baseline by more than %.0f%%:' % (threshold * 100))
+		for r in regressions:
+			print('    ' + r)
+		sys.exit(1)
+	print('No stage is more than %.0f%% slower than the baseline.' % (threshold * 100))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,6 @@
+# Shared by the benchmarks that time traversal and MML without converting samples
+import it2amk
+
+class StubEventTable(it2amk.EventTable):
+	def get_sample_tunings(self, unused_samples, max_lengths=None):
+		return { s: ('%02d.brr' % s, '$03 $00') for s in sorted(self.used_samples) }
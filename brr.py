@@ -0,0 +1,257 @@
+"""
+BRR encoder for SNES samples.
+
+A BRR block is a header byte (shift range << 4 | filter << 2 | loop << 1 | end) followed by 16
+signed 4-bit samples, two per byte, high nibble first. The DSP decodes each nibble as
+(nibble << shift) >> 1 plus a prediction from the two previous decoded samples, so every block is
+encoded against the decoder's actual history rather than the source PCM.
+"""
+
+import numpy as np
+
+BLOCK_SAMPLES = 16
+BLOCK_BYTES = 9
+
+def clamp16(s):
+	return min(max(s, -0x8000), 0x7FFF)
+
+def clip15(s):
+	# Clamped to 16 bits, then wrapped to 15 bits the way the DSP does it
+	s = clamp16(s) & 0x7FFF
+	return s - 0x8000 if s > 0x3FFF else s
+
+def predict(filter, p1, p2):
+	if filter == 0:
+		return 0
+	elif filter == 1:
+		return p1 + ((-p1) >> 4)
+	elif filter == 2:
+		return (p1 << 1) + ((-p1 * 3) >> 5) - p2 + (p2 >> 4)
+	else:
+		return (p1 << 1) + ((-p1 * 13) >> 6) - p2 + ((p2 * 3) >> 4)
+
+def decode_nibble(nibble, shift):
+	if shift <= 12:
+		return (nibble << shift) >> 1
+	return -2048 if nibble < 0 else 0
+
+def encode_block(block, filter, shift, p1, p2, limit=None):
+	"""
+	Quantize 16 samples (15-bit, as the decoder outputs them) with one filter and shift.
+	Returns (squared error, nibbles, p1, p2), or None as soon as the error goes over limit.
+	"""
+	error = 0
+	nibbles = []
+	half = (1 << shift) >> 1
+	for x in block:
+		prediction = predict(filter, p1, p2)
+		if shift > 0:
+			nibble = (x - prediction + (half >> 1)) // half
+		else:
+			nibble = (x - prediction) * 2
+		nibble = min(max(nibble, -8), 7)
+
+		s = clip15(decode_nibble(nibble, shift) + prediction)
+		error += (x - s) * (x - s)
+		if limit is not None and error > limit:
+			return None
+		nibbles.append(nibble)
+		p2, p1 = p1, s
+	return error, nibbles, p1, p2
+
+def pack_block(filter, shift, nibbles, loop=False, end=False):
+	data = bytearray([(shift << 4) | (filter << 2) | (0x02 if loop else 0) | (0x01 if end else 0)])
+	for i in range(0, BLOCK_SAMPLES, 2):
+		data.append(((nibbles[i] & 0xF) << 4) | (nibbles[i + 1] & 0xF))
+	return data
+
+def initial_block_needed(pcm):
+	return any(s != 0 for s in pcm[:BLOCK_SAMPLES])
+
+def brr_size(length, initial_block):
+	return BLOCK_BYTES * length // BLOCK_SAMPLES + (BLOCK_BYTES if initial_block else 0)
+
+def encode_candidates(blocks, filters, shifts, p1, p2):
+	"""
+	encode_block for many candidates at once. blocks is an (..., 16) array of 15-bit samples and
+	filters, shifts, p1 and p2 are arrays that broadcast against blocks[..., 0]; the result has one
+	entry per broadcast candidate. Returns (squared errors, nibbles, p1, p2).
+	"""
+	shape = np.broadcast_shapes(blocks.shape[:-1], np.shape(filters), np.shape(shifts), np.shape(p1), np.shape(p2))
+	half = (1 << shifts) >> 1
+	safe_half = np.maximum(half, 1)
+	quarter = half >> 1
+	f1, f2, f3 = filters == 1, filters == 2, filters == 3
+	p1 = np.broadcast_to(p1, shape).astype(np.int64)
+	p2 = np.broadcast_to(p2, shape).astype(np.int64)
+
+	errors = np.zeros(shape, dtype=np.int64)
+	nibbles = np.empty(shape + (BLOCK_SAMPLES,), dtype=np.int64)
+	for i in range(0, BLOCK_SAMPLES):
+		x = blocks[..., i]
+		prediction = np.where(f1, p1 + ((-p1) >> 4), 0)
+		prediction = np.where(f2, (p1 << 1) + ((-p1 * 3) >> 5) - p2 + (p2 >> 4), prediction)
+		prediction = np.where(f3, (p1 << 1) + ((-p1 * 13) >> 6) - p2 + ((p2 * 3) >> 4), prediction)
+
+		e = x - prediction
+		nibble = np.clip(np.where(shifts > 0, (e + quarter) // safe_half, e * 2), -8, 7)
+		s = np.clip(((nibble << shifts) >> 1) + prediction, -0x8000, 0x7FFF) & 0x7FFF
+		s = np.where(s > 0x3FFF, s - 0x8000, s)
+
+		errors += (x - s) * (x - s)
+		nibbles[..., i] = nibble
+		p2, p1 = p1, s
+	return errors, nibbles, p1, p2
+
+# Every filter/shift candidate, filter-major so ties go to the lowest filter, then the lowest shift
+candidate_filters = np.repeat(np.arange(0, 4), 13)
+candidate_shifts = np.tile(np.arange(0, 13), 4)
+loop_mask = np.where(candidate_filters == 0, 0, np.iinfo(np.int64).max // 4) # Only filter 0 at the loop block
+
+def estimate_errors(blocks, loop_block, chunk=2048):
+	"""
+	Error of every candidate for every block, using the source samples as decoder history. That
+	makes every block independent, so the whole sample is searched with array operations.
+	"""
+	history = np.concatenate((np.zeros((1, 2), dtype=np.int64), blocks[:-1, -2:]))
+	errors = np.empty((len(blocks), len(candidate_filters)), dtype=np.int64)
+	for start in range(0, len(blocks), chunk):
+		end = min(start + chunk, len(blocks))
+		errors[start:end] = encode_candidates(blocks[start:end, None, :], candidate_filters, candidate_shifts,
+		                                      history[start:end, 1:2], history[start:end, 0:1])[0]
+	if loop_block is not None:
+		errors[loop_block] += loop_mask
+	return errors
+
+def estimate_blocks(blocks, loop_block):
+	# Best candidate per block from estimate_errors. Returns (candidates, errors).
+	errors = estimate_errors(blocks, loop_block)
+	best = np.argmin(errors, axis=1)
+	return best, errors[np.arange(len(blocks)), best]
+
+def search_exact(blocks, loop_block):
+	"""
+	Every filter and shift for each block, encoded against the real decoder history, keeping the
+	one with the least error like a full search does. Candidates are tried in the order of their
+	estimate_errors, and each one stops as soon as it's worse than the best so far, so most of them
+	only cost a few samples.
+	"""
+	order = np.argsort(estimate_errors(blocks, loop_block), axis=1, kind='stable').tolist()
+	block_list = blocks.tolist()
+	filters, shifts = candidate_filters.tolist(), candidate_shifts.tolist()
+
+	choices = []
+	p1, p2 = 0, 0
+	for b in range(0, len(blocks)):
+		best, best_c = None, None
+		for c in order[b]:
+			if b == loop_block and filters[c] != 0:
+				continue
+			result = encode_block(block_list[b], filters[c], shifts[c], p1, p2, None if best is None else best[0])
+			if result is not None and (best is None or result[0] < best[0] or c < best_c): # Ties go to the lowest candidate
+				best, best_c = result, c
+		choices.append((filters[best_c], shifts[best_c], best[1]))
+		p1, p2 = best[2], best[3]
+	return choices
+
+def search_greedy(blocks, loop_block):
+	"""
+	Pick each block's filter and shift from estimate_blocks, then encode against the real decoder
+	history. Blocks that come out noticeably worse than estimated get a full search.
+	"""
+	estimate, estimated = estimate_blocks(blocks, loop_block)
+	block_list = blocks.tolist()
+
+	choices = []
+	p1, p2 = 0, 0
+	for b in range(0, len(blocks)):
+		filter, shift = int(candidate_filters[estimate[b]]), int(candidate_shifts[estimate[b]])
+		error, nibbles, n1, n2 = encode_block(block_list[b], filter, shift, p1, p2)
+		if error > 2 * int(estimated[b]) + BLOCK_SAMPLES:
+			errors, all_nibbles, all_p1, all_p2 = encode_candidates(blocks[b], candidate_filters, candidate_shifts, p1, p2)
+			if b == loop_block:
+				errors += loop_mask
+			c = int(np.argmin(errors))
+			filter, shift = int(candidate_filters[c]), int(candidate_shifts[c])
+			nibbles, n1, n2 = all_nibbles[c].tolist(), int(all_p1[c]), int(all_p2[c])
+		choices.append((filter, shift, nibbles))
+		p1, p2 = n1, n2
+	return choices
+
+def search_beam(blocks, loop_block, width):
+	"""
+	Beam search over blocks: keep the width encodings with the lowest total error so far and try
+	every candidate for the next block from each of them. A block choice that costs a little now
+	can leave the decoder in a better state for the following blocks.
+	"""
+	p1 = np.zeros(1, dtype=np.int64)
+	p2 = np.zeros(1, dtype=np.int64)
+	totals = np.zeros(1, dtype=np.int64)
+	steps = []
+	for b in range(0, len(blocks)):
+		errors, nibbles, n1, n2 = encode_candidates(blocks[b], candidate_filters[None, :], candidate_shifts[None, :],
+		                                            p1[:, None], p2[:, None])
+		if b == loop_block:
+			errors += loop_mask
+		costs = (totals[:, None] + errors).ravel()
+		keep = np.argsort(costs, kind='stable')[:width]
+		steps.append((keep // len(candidate_filters), keep % len(candidate_filters), nibbles.reshape(-1, BLOCK_SAMPLES)[keep]))
+		p1, p2, totals = n1.ravel()[keep], n2.ravel()[keep], costs[keep]
+
+	choices = []
+	state = 0
+	for parents, candidates, nibbles in reversed(steps):
+		c = candidates[state]
+		choices.append((int(candidate_filters[c]), int(candidate_shifts[c]), nibbles[state].tolist()))
+		state = parents[state]
+	choices.reverse()
+	return choices
+
+def encode(pcm, loop_start=None, beam=1, fast=False):
+	"""
+	Encode 16-bit mono PCM (a multiple of 16 samples long) to BRR data. If loop_start is given
+	(a multiple of 16), the last block loops back to it and the loop block only uses filter 0,
+	since the decoder history differs between the first pass and every loop. Each block gets the
+	filter and shift with the least error (search_exact). fast picks them from estimates instead,
+	which is several times faster but a little noisier, and a beam width above 1 searches for
+	better block combinations at the cost of speed.
+
+	A silent block is added in front when the first block isn't silent, like brr_encoder does.
+	Returns (brr bytes, block offset of the loop point).
+	"""
+	assert len(pcm) % BLOCK_SAMPLES == 0
+
+	blocks = (np.asarray(pcm, dtype=np.int64) >> 1).reshape(-1, BLOCK_SAMPLES)
+	first_loop_block = None if loop_start is None else loop_start // BLOCK_SAMPLES
+	if fast:
+		choices = search_greedy(blocks, first_loop_block)
+	elif beam > 1:
+		choices = search_beam(blocks, first_loop_block, beam)
+	else:
+		choices = search_exact(blocks, first_loop_block)
+
+	data = bytearray()
+	if initial_block_needed(pcm):
+		data += pack_block(0, 0, [0] * BLOCK_SAMPLES)
+	loop_block = None if loop_start is None else len(data) // BLOCK_BYTES + first_loop_block
+
+	for b in range(0, len(choices)):
+		filter, shift, nibbles = choices[b]
+		data += pack_block(filter, shift, nibbles, loop_start is not None, b == len(choices) - 1)
+
+	return bytes(data), loop_block
+
+def decode(data):
+	"""Decode BRR data (without the AMK loop header) back to 16-bit PCM."""
+	pcm = []
+	p1, p2 = 0, 0
+	for b in range(0, len(data) // BLOCK_BYTES):
+		header = data[b * BLOCK_BYTES]
+		shift, filter = header >> 4, (header >> 2) & 0x3
+		for i in range(1, BLOCK_BYTES):
+			for nibble in (data[b * BLOCK_BYTES + i] >> 4, data[b * BLOCK_BYTES + i] & 0xF):
+				nibble = nibble - 16 if nibble > 7 else nibble
+				s = clip15(decode_nibble(nibble, shift) + predict(filter, p1, p2))
+				pcm.append(s * 2)
+				p2, p1 = p1, s
+	return pcm
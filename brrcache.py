@@ -0,0 +1,81 @@
+"""
+Content-addressed cache of converted samples.
+
+An entry is the finished .brr file (AMK loop header included) plus its tuning and fingerprint,
+stored under a hash of everything that goes into it: the raw IT sample data and format, loop
+points, C5 speed and the conversion settings. A hit is read and written to the samples folder
+without converting anything. Once the cache grows past its size limit, the least recently used
+entries are removed.
+"""
+
+import hashlib
+import os
+
+class BRRCache:
+	def __init__(self, folder, max_size):
+		self.folder = folder
+		self.max_size = max_size
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+
+	@staticmethod
+	def key(it_sample, settings):
+		# settings is a tuple of everything else that changes the output (ratios, encoder version, ...)
+		data = it_sample.SampleData if it_sample.IsSample else b''
+		if isinstance(data, str):
+			data = data.encode('latin-1')
+
+		h = hashlib.sha256()
+		h.update(repr((it_sample.IsSample, it_sample.Is16bit, it_sample.IsStereo, it_sample.IsCompressed,
+		               it_sample.IsLooped, it_sample.IsPingPongLoop, it_sample.Cvt, it_sample.LoopBegin,
+		               it_sample.LoopEnd, it_sample.C5Speed, settings)).encode('utf-8'))
+		h.update(data)
+		return h.hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.folder, key + '.brr')
+
+	def get(self, key):
+		# Returns (brr data, tuning, fingerprint), or None on a miss. The BRR is read right away, so an
+		# entry another process evicts afterwards is still used, and one evicted before is a miss.
+		# Hits count as a use for eviction.
+		try:
+			with open(os.path.join(self.folder, key + '.info'), 'r') as file:
+				tuning, fingerprint = file.read().split('\n')[:2]
+			with open(self.path(key), 'rb') as file:
+				brr_data = file.read()
+			os.utime(self.path(key))
+		except (OSError, ValueError):
+			return None
+		return brr_data, tuning, fingerprint
+
+	def put(self, key, brr_data, tuning, fingerprint):
+		# Written to a temporary name first so other conversions never see half an entry
+		for ext, content, mode in (('.brr', brr_data, 'wb'), ('.info', tuning + '\n' + fingerprint + '\n', 'w')):
+			tmp = os.path.join(self.folder, key + ext + '.' + str(os.getpid()))
+			with open(tmp, mode) as file:
+				file.write(content)
+			os.replace(tmp, os.path.join(self.folder, key + ext))
+
+	def evict(self):
+		# Called once a conversion is done with the cache. Other processes using the same folder may
+		# evict at any time, which get() allows for.
+		entries = []
+		for f in os.listdir(self.folder):
+			if f.endswith('.brr'):
+				try:
+					st = os.stat(os.path.join(self.folder, f))
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, f[:-4]))
+
+		total = sum(e[1] for e in entries)
+		for mtime, size, key in sorted(entries):
+			if total <= self.max_size:
+				break
+			for ext in ('.brr', '.info'):
+				try:
+					os.remove(os.path.join(self.folder, key + ext))
+				except OSError:
+					pass
+			total -= size
@@ -0,0 +1,313 @@
+"""
+Conversion daemon: keeps a pool of worker processes with it2amk, numpy and the ADSR and resampler
+tables loaded, so a conversion doesn't pay for starting Python every time.
+
+    python daemon.py --serve [--jobs n] [--socket path | --tcp port]    start the daemon
+    python daemon.py --stop [--socket path | --tcp port]                stop it
+    python daemon.py [--socket path | --tcp port] <module_file> <flags>  convert through the daemon
+
+The client converts in-process like it2amk.py when no daemon is listening.
+
+Jobs can read and write files anywhere the daemon's user can, so only that user may connect. By
+default the daemon listens on a Unix domain socket (mode 0600) in a folder only its user can open:
+$XDG_RUNTIME_DIR, or it2amk-<uid> (mode 0700) in the temp folder. The client won't use a socket or
+token file it doesn't own, and where the OS tells (SO_PEERCRED on Linux) both ends check that the
+other runs as the same user. With --tcp the daemon listens on 127.0.0.1 instead, which every local
+user can reach, so it writes a random token to a file in that folder, and the first line of every
+connection has to be {"op": "auth", "token"} with that token. Where there are no Unix domain
+sockets, the daemon only runs with --tcp.
+
+Requests and replies are JSON, one per line, and a connection can have any number of jobs in
+flight. A job is either {"id", "path", "cwd", "args"}, which converts a module file into
+music/ and samples/ under cwd exactly like the command line, or {"id", "module", "options", "name"}
+with the module base64 encoded, which goes through it2amk.convert() and sends back the MML, BRRs,
+tunings, stats and messages. Every job gets a {"id", "status": "started"} line, then one with "status": "done" or
+"failed" once it's finished, in whatever order the jobs finish.
+"""
+
+import asyncio
+import base64
+import concurrent.futures
+import getpass
+import hmac
+import json
+import multiprocessing
+import os
+import secrets
+import socket
+import stat
+import struct
+import sys
+import tempfile
+
+import it2amk
+
+line_limit = 1 << 30 # Requests carry whole modules
+
+def check_owner(path):
+	# Raises PermissionError unless path is this user's and no symlink, and closed to others if it's
+	# a folder. Windows has no uids, but its temp folder is already per user.
+	if not hasattr(os, 'getuid'):
+		return
+	st = os.lstat(path)
+	if st.st_uid != os.getuid() or stat.S_ISLNK(st.st_mode) or (stat.S_ISDIR(st.st_mode) and st.st_mode & 0o077):
+		raise PermissionError('"' + path + '" belongs to another user or is open to them.')
+
+def runtime_folder():
+	# Where the socket and token file go, so no other user can put theirs there first
+	if not hasattr(os, 'getuid'):
+		folder = os.path.join(tempfile.gettempdir(), 'it2amk-' + getpass.getuser())
+		os.makedirs(folder, exist_ok=True)
+		return folder
+	folder = os.environ.get('XDG_RUNTIME_DIR', '')
+	if folder == '' or not os.path.isdir(folder):
+		folder = os.path.join(tempfile.gettempdir(), 'it2amk-' + str(os.getuid()))
+		try:
+			os.mkdir(folder, 0o700)
+		except FileExistsError:
+			pass
+	check_owner(folder)
+	return folder
+
+def default_socket():
+	return os.path.join(runtime_folder(), 'it2amk.sock')
+
+def token_file(port):
+	return os.path.join(runtime_folder(), 'it2amk-' + str(port) + '.token')
+
+def write_token(path, token):
+	# Any old file is removed first, so the new one is created with mode 0600
+	if os.path.exists(path):
+		os.remove(path)
+	with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as file:
+		file.write(token)
+
+def peer_uid(sock):
+	# The uid of the process at the other end of a Unix domain socket, or None where the OS doesn't tell
+	if not hasattr(socket, 'SO_PEERCRED'):
+		return None
+	pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+	return uid
+
+def init_worker():
+	import sampconv # Load numpy and the encoder before the first job arrives
+
+def run_job(job, defaults):
+	if 'path' in job:
+		os.chdir(job['cwd']) # Each worker runs one job at a time, so this is safe
+		path, error, seconds, cpu, log = it2amk.convert_batch_module(job['path'], job['args'], defaults)
+		return { 'status' : 'failed' if error else 'done', 'error' : error, 'seconds' : seconds, 'cpu' : cpu, 'log' : log }
+
+	try:
+		options = dict(job.get('options') or {})
+		if defaults.flag('sjobs') == 1 and not any(it2amk.Config.flag_aliases.get(f.lstrip('-'), f.lstrip('-')) == 'sjobs' for f in options):
+			options['sjobs'] = 1
+		result = it2amk.convert(base64.b64decode(job['module']), options, job.get('name', 'module'))
+	except it2amk.CompileErrorException as e:
+		return { 'status' : 'failed', 'error' : str(e) }
+	return {
+		'status' : 'done',
+		'mml' : result.mml,
+		'samples' : { f : base64.b64encode(b).decode('ascii') for f, b in result.samples.items() },
+		'tunings' : { str(s) : t for s, t in result.tunings.items() },
+		'stats' : result.stats,
+		'messages' : result.messages
+	}
+
+class Daemon:
+	def __init__(self, jobs):
+		self.jobs = jobs if jobs > 0 else (os.cpu_count() or 1)
+		self.defaults = it2amk.Config()
+		if self.jobs > 1:
+			self.defaults.set_flag('sjobs', '1') # The jobs already keep every core busy
+		self.executor = self.start_pool()
+		self.stopped = None
+		self.token = None # Required from TCP connections
+		self.tcp = False
+
+	def start_pool(self):
+		# Spawned rather than forked, so the workers don't hold on to the client connections
+		return concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs, initializer=init_worker,
+		                                              mp_context=multiprocessing.get_context('spawn'))
+
+	async def serve(self, address):
+		self.stopped = asyncio.get_running_loop().create_future()
+		if isinstance(address, str):
+			if os.path.exists(address):
+				os.remove(address) # Left over from a daemon that didn't shut down cleanly
+			umask = os.umask(0o177) # Created as 0600, so other users can't connect even for a moment
+			try:
+				server = await asyncio.start_unix_server(self.handle, address, limit=line_limit)
+			finally:
+				os.umask(umask)
+		else:
+			# The token file is only written once the port is this daemon's, so a client never sends
+			# the token to whoever had the port first
+			self.tcp = True
+			self.token = secrets.token_hex(32)
+			server = await asyncio.start_server(self.handle, '127.0.0.1', address, limit=line_limit)
+			write_token(token_file(address), self.token)
+		print('it2amk daemon listening on ' + str(address) + ' with ' + str(self.jobs) + ' worker(s)')
+
+		async with server:
+			await self.stopped
+		self.executor.shutdown()
+		os.remove(address if isinstance(address, str) else token_file(address))
+
+	async def authorized(self, reader):
+		# Whether the connection's first line is {"op": "auth", "token"} with this daemon's token
+		try:
+			auth = json.loads(await reader.readline())
+		except ValueError:
+			return False
+		return (isinstance(auth, dict) and auth.get('op') == 'auth' and
+		        hmac.compare_digest(str(auth.get('token')).encode('utf-8'), self.token.encode('utf-8')))
+
+	async def handle(self, reader, writer):
+		lock = asyncio.Lock()
+		tasks = []
+
+		async def send(message):
+			async with lock:
+				writer.write((json.dumps(message) + '\n').encode('utf-8'))
+				await writer.drain()
+
+		async def convert(job):
+			await send({ 'id' : job.get('id'), 'status' : 'started' })
+			try:
+				reply = await asyncio.get_running_loop().run_in_executor(self.executor, run_job, job, self.defaults)
+			except concurrent.futures.process.BrokenProcessPool: # A worker died; start a new pool for the next jobs
+				self.executor = self.start_pool()
+				reply = { 'status' : 'failed', 'error' : 'The worker process died.' }
+			except Exception as e:
+				reply = { 'status' : 'failed', 'error' : type(e).__name__ + ': ' + str(e) }
+			reply['id'] = job.get('id')
+			await send(reply)
+
+		try:
+			if self.tcp:
+				allowed = await self.authorized(reader)
+			else:
+				allowed = peer_uid(writer.get_extra_info('socket')) in (None, os.getuid())
+			if not allowed:
+				await send({ 'status' : 'failed', 'error' : 'Not authorized.' })
+				return
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				try:
+					job = json.loads(line)
+					if not isinstance(job, dict):
+						raise ValueError
+				except ValueError:
+					await send({ 'status' : 'failed', 'error' : 'Malformed request.' })
+					continue
+				if job.get('op') == 'stop':
+					self.stopped.set_result(None)
+					break
+				tasks.append(asyncio.create_task(convert(job)))
+			await asyncio.gather(*tasks)
+		except ConnectionError:
+			pass
+		finally:
+			writer.close()
+
+def connect(address):
+	# Returns a connected socket, or None if no daemon is listening. Raises PermissionError if the
+	# socket or token file isn't this user's, or another user's process is listening.
+	if address is None:
+		return None
+	try:
+		if isinstance(address, str):
+			check_owner(address)
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			sock.connect(address)
+			if peer_uid(sock) not in (None, os.getuid()):
+				sock.close()
+				raise PermissionError('The daemon at "' + address + '" runs as another user.')
+		else:
+			path = token_file(address)
+			check_owner(path)
+			with open(path, 'r') as file:
+				token = file.read()
+			sock = socket.create_connection(('127.0.0.1', address))
+			sock.sendall((json.dumps({ 'op' : 'auth', 'token' : token }) + '\n').encode('utf-8'))
+	except PermissionError:
+		raise
+	except OSError:
+		return None
+	return sock
+
+def request(sock, jobs):
+	# Send the jobs and yield the replies as they arrive
+	sock.sendall(''.join(json.dumps(j) + '\n' for j in jobs).encode('utf-8'))
+	sock.shutdown(socket.SHUT_WR)
+	with sock.makefile('r', encoding='utf-8') as file:
+		for line in file:
+			yield json.loads(line)
+
+def client(address, module_path, args):
+	sock = connect(address)
+	if sock is None:
+		print('No it2amk daemon running, converting in-process.')
+		try:
+			it2amk.convert_module(module_path, args)
+		except it2amk.CompileErrorException as e:
+			print('Error:', e)
+			return 1
+		return 0
+
+	job = { 'id' : 1, 'path' : os.path.abspath(module_path), 'cwd' : os.getcwd(), 'args' : args }
+	for reply in request(sock, [job]):
+		if reply['status'] == 'started':
+			continue
+		if reply.get('log'):
+			print(reply['log'], end='')
+		elif reply['status'] != 'done':
+			print('Error:', reply['error'])
+		return 0 if reply['status'] == 'done' else 1
+	return 1
+
+def main():
+	try:
+		run(sys.argv[1:])
+	except PermissionError as e:
+		print('Error:', e)
+		sys.exit(1)
+
+def run(args):
+	address = None
+	for flag in ('--socket', '--tcp'):
+		if flag in args[:-1]:
+			i = args.index(flag)
+			address = args[i + 1] if flag == '--socket' else int(args[i + 1])
+			del args[i:i + 2]
+	if address is None and hasattr(socket, 'AF_UNIX'):
+		address = default_socket()
+
+	if len(args) >= 1 and args[0] in ('--serve', '--stop') and address is None:
+		print('Error: There are no Unix domain sockets here, so the daemon needs --tcp port.')
+		sys.exit(1)
+	if len(args) >= 1 and args[0] == '--serve':
+		jobs = int(args[args.index('--jobs') + 1]) if '--jobs' in args else 0
+		try:
+			asyncio.run(Daemon(jobs).serve(address))
+		except KeyboardInterrupt:
+			pass
+	elif len(args) >= 1 and args[0] == '--stop':
+		sock = connect(address)
+		if sock is None:
+			print('No it2amk daemon running.')
+			sys.exit(1)
+		list(request(sock, [{ 'op' : 'stop' }]))
+	elif len(args) == 0 or len(args) % 2 != 1:
+		print('Usage: python daemon.py <module_file> <flags>')
+		print('       python daemon.py --serve [--jobs n] [--socket path | --tcp port]')
+		print('       python daemon.py --stop [--socket path | --tcp port]')
+		sys.exit(1)
+	else:
+		sys.exit(client(address, args[0], args[1:]))
+
+if __name__ == '__main__':
+	main()
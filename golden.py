@@ -0,0 +1,183 @@
+"""
+Golden output check: converts every module in the corpus and compares the MML and sample tunings with
+the files in golden/, so changes to EventTable, MML or pyIT that are only meant to be faster can be
+checked to change nothing.
+
+    python golden.py [--jobs n] [--only name] [--update true]
+
+The corpus is the example modules, with the default flags and a few others, and modules written by
+itgen.py. Conversions go through it2amk.convert() with nosmpl, so samples are resampled for their
+tunings but not encoded, and nothing is written outside golden/. The exit code is 1 if any output
+differs from its golden file (a short diff is printed) or has none. --update true writes the current
+output as the new golden files.
+
+The modules in thread_corpus are converted twice with their samples encoded, once with the samples
+converted in the background while the MML is written and once synchronously, and the two must give
+the same MML and BRRs. They have no golden files.
+"""
+
+import concurrent.futures
+import difflib
+import os
+import sys
+import tempfile
+
+import it2amk
+import itgen
+
+root = os.path.dirname(os.path.abspath(__file__))
+golden_folder = os.path.join(root, 'golden')
+diff_lines = 30 # Lines of diff shown per mismatching file
+line_width = 160 # Longer diff lines are cut off
+
+# (name, example module or itgen.write_module() arguments, it2amk options)
+corpus = [
+	('example1', 'example1.it', {}),
+	('example2', 'example2.it', {}),
+	('example3', 'example3.it', {}),
+	('example4', 'example4.it', {}),
+	('example2-tempo', 'example2.it', { 'tmult' : 1.5, 'vmult' : 1.7 }),
+	('example3-notelen', 'example3.it', { 'tmult' : 3, 'notelen' : True }),
+	('example4-truncate', 'example4.it', { 'truncate' : True, 'resample' : 0.8 }),
+	('gen-dense', { 'seed' : 11, 'patterns' : 6, 'rows' : 32, 'effects' : 0.5 }, {}),
+	('gen-loops', { 'seed' : 12, 'patterns' : 6, 'rows' : 32, 'orders' : 20, 'loops' : 1.0 }, {}),
+	('gen-envelopes', { 'seed' : 13, 'patterns' : 4, 'rows' : 32, 'instruments' : 20, 'nodes' : 12 }, {}),
+	('gen-compressed', { 'seed' : 14, 'patterns' : 2, 'rows' : 32, 'sample_bits' : 8, 'sample_length' : 20000, 'compressed' : True, 'it215' : True }, {}),
+	('gen-flags', { 'seed' : 15, 'patterns' : 4, 'rows' : 32, 'flags' : '-t 3 -vm 1.3 -nl true -l false' }, {}),
+	('gen-wide', { 'seed' : 16, 'patterns' : 4, 'rows' : 32, 'channels' : 64, 'effects' : 0.2 }, {})
+]
+
+# (name, itgen.write_module() arguments, it2amk options) for the threaded against synchronous check
+thread_corpus = [
+	('threads-truncate', { 'seed' : 1, 'patterns' : 1, 'rows' : 8, 'nodes' : 4, 'notes' : 0.3, 'sample_length' : 100000,
+	                       'instruments' : 4, 'sample_loops' : False }, { 'truncate' : True, 'legato' : False })
+]
+
+def read_module(name, module, folder):
+	if isinstance(module, dict):
+		path = os.path.join(folder, name + '.it')
+		itgen.write_module(path, **module)
+	else:
+		path = os.path.join(root, 'modules', module)
+	with open(path, 'rb') as file:
+		return file.read()
+
+def convert_case(name, module, options, folder):
+	# Returns (name, MML, tunings text, error message or None)
+	module_bytes = read_module(name, module, folder)
+	options = dict(options, nosmpl=True, sjobs=1)
+	try:
+		result = it2amk.convert(module_bytes, options, name)
+	except it2amk.CompileErrorException as e:
+		return name, '', '', str(e)
+	tunings = ''.join('%d "%s" %s\n' % (s, brr, tuning) for s, (brr, tuning) in sorted(result.tunings.items()))
+	return name, result.mml, tunings, None
+
+def check_threads(name, module, options, folder):
+	# Returns (name, what differs between the threaded and synchronous conversions, or None)
+	module_bytes = read_module(name, module, folder)
+	options = dict(options, sjobs=1)
+	try:
+		threaded = it2amk.convert(module_bytes, options, name)
+		synchronous = it2amk.convert(module_bytes, options, name, synchronous=True)
+	except it2amk.CompileErrorException as e:
+		return name, ['    ' + str(e)]
+	diffs = []
+	if threaded.mml != synchronous.mml:
+		diffs.append('    the MML differs')
+	for brr in sorted(set(threaded.samples) | set(synchronous.samples)):
+		if threaded.samples.get(brr) != synchronous.samples.get(brr):
+			diffs.append('    ' + brr + ' differs')
+	return name, diffs or None
+
+def compare(filename, text):
+	# A short diff between the golden file and text, or None if they're the same
+	try:
+		with open(filename, 'r', newline='') as file:
+			golden = file.read()
+	except OSError:
+		return ['    no golden file ' + os.path.relpath(filename, root)]
+	if golden == text:
+		return None
+
+	# MML lines are long, so point at the first character that differs as well
+	old, new = golden.splitlines(), text.splitlines()
+	line = next((i for i in range(min(len(old), len(new))) if old[i] != new[i]), min(len(old), len(new)))
+	lines = []
+	if line < len(old) and line < len(new):
+		col = next((i for i in range(min(len(old[line]), len(new[line]))) if old[line][i] != new[line][i]), min(len(old[line]), len(new[line])))
+		start = max(col - 30, 0)
+		lines.append('first difference at line %d, column %d:' % (line + 1, col + 1))
+		lines.append('  golden: ' + old[line][start:col + 30])
+		lines.append('  now:    ' + new[line][start:col + 30])
+
+	diff = list(difflib.unified_diff(old, new, 'golden', 'now', n=1, lineterm=''))
+	if len(diff) > diff_lines:
+		diff = diff[:diff_lines] + ['... ' + str(len(diff) - diff_lines) + ' more line(s)']
+	return ['    ' + (l if len(l) <= line_width else l[:line_width] + '...') for l in lines + diff]
+
+def main():
+	options = { 'jobs' : '0', 'only' : '', 'update' : 'false' }
+	args = sys.argv[1:]
+	if len(args) % 2 != 0 or any(not a.startswith('--') or a[2:] not in options for a in args[::2]):
+		print('Usage: python golden.py [--jobs n] [--only name] [--update true]')
+		sys.exit(1)
+	for i in range(0, len(args), 2):
+		options[args[i][2:]] = args[i + 1]
+	update = options['update'].lower() == 'true'
+
+	cases = [c for c in corpus if options['only'] in ('', c[0])]
+	thread_cases = [c for c in thread_corpus if options['only'] in ('', c[0])]
+	if len(cases) + len(thread_cases) == 0:
+		print('Error: No corpus module named "' + options['only'] + '".')
+		sys.exit(1)
+	jobs = int(options['jobs'])
+	jobs = min(jobs if jobs > 0 else (os.cpu_count() or 1), len(cases) + len(thread_cases))
+
+	with tempfile.TemporaryDirectory() as folder:
+		if jobs <= 1:
+			results = [convert_case(*c, folder) for c in cases]
+			thread_results = [check_threads(*c, folder) for c in thread_cases]
+		else:
+			with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+				thread_futures = [executor.submit(check_threads, *c, folder) for c in thread_cases]
+				results = list(executor.map(convert_case, *zip(*cases), [folder] * len(cases))) if cases else []
+				thread_results = [f.result() for f in thread_futures]
+
+	failed = 0
+	os.makedirs(golden_folder, exist_ok=True)
+	for name, mml, tunings, error in results:
+		if error is not None:
+			print(name + ': FAILED: ' + error)
+			failed += 1
+			continue
+		files = [(os.path.join(golden_folder, name + '.txt'), mml), (os.path.join(golden_folder, name + '.tunings'), tunings)]
+		if update:
+			for filename, text in files:
+				with open(filename, 'w', newline='') as file:
+					file.write(text)
+			print(name + ': updated')
+			continue
+		diffs = [d for d in (compare(f, t) for f, t in files) if d is not None]
+		if len(diffs) == 0:
+			print(name + ': ok')
+		else:
+			print(name + ': DIFFERS')
+			for d in diffs:
+				print('\n'.join(d))
+			failed += 1
+
+	for name, diffs in thread_results:
+		if diffs is None:
+			print(name + ': ok')
+		else:
+			print(name + ': threaded and synchronous conversions differ')
+			print('\n'.join(diffs))
+			failed += 1
+
+	if failed > 0:
+		print(str(failed) + ' of ' + str(len(results) + len(thread_results)) + ' module(s) failed.')
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
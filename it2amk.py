@@ -1,10 +1,24 @@
 import pyIT
+import pyitcompress
+import aram
 import math
 import sys
 import re
 import subprocess
 import os
 import operator
+import pickle
+import bisect
+import concurrent.futures
+import contextlib
+import cProfile
+import copy
+import glob
+import hashlib
+import io
+import multiprocessing
+import struct
+import time
 
 #TODO: Make it so it outputs everything up one directory so the file structure can be AddMusicK/it2amk instead of having to copy the results every heckin time
 #TODO: Alternately, add functions to copy the contents of it2amk/music and it2amk/samples into AddMusicK/music and AddMusicK/samples?
@@ -12,9 +26,16 @@ import operator
 previous_textfile_filename = "it2amk_last_run.txt" #this is gonna make things a heck of a lot easier
 
 def main():
-	global module_path
+	if len(sys.argv) >= 2 and sys.argv[1] in ('--batch', '-b'):
+		batch_main()
+		return
+	if len(sys.argv) >= 2 and sys.argv[1] in ('--watch', '-w'):
+		watch_main()
+		return
 	if (len(sys.argv)) < 2:
 		print('Usage: python it2amk.py <module_file> <flags>')
+		print('       python it2amk.py --batch <folder or glob> [--jobs n] <flags>')
+		print('       python it2amk.py --watch <module_file> <flags>')
 		if os.path.exists(previous_textfile_filename):
 			run_previous = input('Would you like to re-run the last module? ')
 			if (run_previous[0].lower()) == "y":
@@ -29,17 +50,35 @@ def main():
 	else:
 		module_path = sys.argv[1] #use the module path from the command line arguments
 
+	args, report, memory, cprofile = get_profile_args(sys.argv[2:])
+	try:
+		if report or memory or cprofile:
+			profile_module(module_path, args, report, memory, cprofile)
+		else:
+			convert_module(module_path, args)
+	except CompileErrorException as e:
+		print('Error:', e)
+
+def convert_module(module_path, args, config=None, synchronous=False):
+	# Convert one module, with args being the command line flag pairs. synchronous converts the
+	# samples on this thread instead of in the background.
+	config = config if config is not None else Config()
+	
 	it = pyIT.ITfile()
 	it.open(module_path)
-	Config.get_module_flags(it)
+	try:
+		config.get_module_flags(it)
+	except ValueError as e:
+		print('Error: ' + str(e))
+		sys.exit(1)
 
-	i = 2
-	while i < len(sys.argv):
-		flag = sys.argv[i]
-		arg = sys.argv[i + 1]
+	i = 0
+	while i < len(args):
+		flag = args[i]
+		arg = args[i + 1]
 
 		try:
-			Config.set_flag(flag, arg)
+			config.set_flag(flag, arg)
 		except ValueError as e:
 			print('Error: ' + str(e))
 			sys.exit(1)
@@ -49,12 +88,340 @@ def main():
 
 		i += 2
 
+	check_samples(it)
+	evtbl = EventTable(it, config, module_path, synchronous=synchronous)
+	mml = MML(evtbl)
+	for message in evtbl.messages:
+		print(message)
+	mml.save('music/' + module_path.split('.')[0].replace('\\', '/').split('/')[-1] + '.txt')
+
+def get_profile_args(args):
+	# Take --profile <report.json>, --profilemem true and --cprofile <file> out of the flag pairs
+	# and return (other args, report, memory, cprofile)
+	report, memory, cprofile = '', False, ''
+	rest = []
+	for i in range(0, len(args) - 1, 2):
+		if args[i] == '--profile':
+			report = args[i + 1]
+		elif args[i] == '--profilemem':
+			memory = args[i + 1].lower() == 'true'
+		elif args[i] == '--cprofile':
+			cprofile = args[i + 1]
+		else:
+			rest += args[i:i + 2]
+	return rest, report, memory, cprofile
+	
+def get_profile_stages():
+	# (owner, function, stage) for every stage --profile times
+	stages = [
+		(pyIT.ITfile, 'load', 'module parse'),
+		(pyIT.ITpattern, 'unpack', 'pattern unpack'),
+		(pyitcompress, 'it_decompress8', 'sample decompression'),
+		(pyitcompress, 'it_decompress16', 'sample decompression'),
+		(EventTable, 'convert', 'traversal'),
+		(EventTable, 'get_sample_tunings', 'sample conversion'),
+		(EventTable, 'fit_ins_adsr', 'ADSR fitting'),
+		(MML, 'convert', 'MML emission'),
+		(MML, 'add_sample_info', 'waiting for samples'),
+		(MML, 'save', 'file write')
+	]
 	try:
-		evtbl = EventTable(it)
-		mml = MML(evtbl)
-		mml.save('music/' + module_path.split('.')[0].replace('\\', '/').split('/')[-1] + '.txt')
-	except CompileErrorException as e:
-		print('Error:', e)
+		import sampconv
+		stages.append((sampconv, 'write_samples', 'file write'))
+	except ImportError:
+		pass # No numpy, so only the sampconv encoder works
+	return stages
+	
+def profile_module(module_path, args, report='', memory=False, cprofile=''):
+	# convert_module() with every stage timed. Prints a table of the stages, and writes it to report
+	# as JSON and a cProfile dump to cprofile if they're given.
+	import profiler
+	prof = profiler.Profiler(memory)
+	prof.hook(get_profile_stages())
+	cprof = cProfile.Profile() if cprofile else None
+	try:
+		if cprof is not None:
+			cprof.enable()
+		prof.run(lambda: convert_module(module_path, args, synchronous=cprof is not None)) # cProfile only sees this thread
+	finally:
+		if cprof is not None:
+			cprof.disable()
+			cprof.dump_stats(cprofile)
+		prof.unhook()
+		
+	print()
+	print(prof.format_table())
+	if report:
+		prof.save(report, module=module_path, args=args)
+		print('Wrote the profile to ' + report + '.')
+	if cprofile:
+		print('Wrote cProfile stats to ' + cprofile + ' (view them with python -m pstats ' + cprofile + ').')
+
+class Result:
+	# What convert() returns. samples maps BRR filenames to their contents, tunings maps sample
+	# numbers to (name in #samples, tuning), like EventTable.sample_dict, and messages lists the
+	# reports the command line prints (truncated, shared and budgeted samples).
+	def __init__(self, mml, samples, tunings, stats, messages=None):
+		self.mml = mml
+		self.samples = samples
+		self.tunings = tunings
+		self.stats = stats
+		self.messages = messages if messages is not None else []
+
+def convert(module_bytes, options=None, name='module', synchronous=False):
+	"""
+	Convert an IT module held in memory and return a Result, without touching the disk. options maps
+	flags (with or without their dashes, or by alias) to values, and is applied on top of the flags
+	in the module message, like command line flags. name is the song name used for #path. The sample
+	cache is off unless options turn it on, and only the native encoder is supported. With synchronous,
+	the samples are converted on the calling thread instead of while the MML is written.
+	"""
+	start = time.perf_counter()
+	config = Config()
+	config.set_flag('cachesize', '0')
+	
+	it = pyIT.ITfile()
+	try:
+		it.load(io.BytesIO(module_bytes))
+	except (AssertionError, struct.error, UnicodeDecodeError):
+		raise CompileErrorException('Not a valid IT module.')
+	check_samples(it)
+	try:
+		config.get_module_flags(it)
+		for flag, value in (options or {}).items():
+			flag = flag if flag.startswith('-') or flag in Config.default_flags else '-' + flag
+			for v in (value if isinstance(value, list) else [value]):
+				config.set_flag(flag, str(v))
+	except ValueError as e:
+		raise CompileErrorException(str(e))
+	if config.flag('encoder') != 'native':
+		raise CompileErrorException('Only the native encoder can convert modules in memory.')
+		
+	evtbl = EventTable(it, config, name, False, synchronous=synchronous)
+	mml = MML(evtbl)
+	
+	samples = {}
+	for p in evtbl.prepared_samples:
+		if p.shared is None and not config.flag('nosmpl'):
+			samples[p.filename] = p.read_brr()
+	stats = {
+		'seconds' : time.perf_counter() - start,
+		'samples' : len(evtbl.prepared_samples),
+		'shared_samples' : sum(1 for p in evtbl.prepared_samples if p.shared is not None),
+		'brr_bytes' : sum(len(b) for b in samples.values()),
+		'mml_bytes' : len(mml.txt)
+	}
+	return Result(mml.txt, samples, dict(evtbl.sample_dict), stats, list(evtbl.messages))
+
+def check_samples(it):
+	# A module cut short still loads, with the samples past the end empty or short
+	for s, smp in enumerate(it.Samples):
+		if smp.IsSample and smp.sampleDataLen() < smp.Length:
+			raise CompileErrorException('Sample ' + str(s + 1) + ' has ' + str(int(smp.sampleDataLen())) + ' of its ' + str(smp.Length) +
+			                            ' frames; the module is incomplete.')
+
+def batch_main():
+	# --jobs/-j only means something to a batch, so it's taken out before the flags are checked
+	args = sys.argv[3:]
+	jobs = 0
+	for i in range(0, len(args) - 1, 2):
+		if args[i] in ('--jobs', '-j'):
+			try:
+				jobs = int(args[i + 1])
+			except ValueError:
+				print('Error: --jobs needs a number, not "' + args[i + 1] + '".')
+				sys.exit(1)
+			del args[i:i + 2]
+			break
+	if len(sys.argv) < 3 or len(args) % 2 != 0:
+		print('Error: Missing flag argument.' if len(sys.argv) >= 3 else 'Usage: python it2amk.py --batch <folder or glob> [--jobs n] <flags>')
+		sys.exit(1)
+		
+	pattern = sys.argv[2]
+	if os.path.isdir(pattern):
+		paths = sorted(os.path.join(pattern, f) for f in os.listdir(pattern) if f.lower().endswith('.it'))
+	else:
+		paths = sorted(glob.glob(pattern))
+	if len(paths) == 0:
+		print('Error: No modules found in "' + pattern + '".')
+		sys.exit(1)
+		
+	# Check the command line flags once up front instead of failing every module on them
+	config = Config()
+	try:
+		for i in range(0, len(args), 2):
+			config.set_flag(args[i], args[i + 1])
+	except ValueError as e:
+		print('Error: ' + str(e))
+		sys.exit(1)
+	
+	jobs = min(jobs if jobs > 0 else (os.cpu_count() or 1), len(paths))
+	defaults = Config()
+	if jobs > 1:
+		# The modules already keep every core busy, so samples are converted serially unless asked otherwise
+		defaults.set_flag('sjobs', '1')
+		
+	print('Converting ' + str(len(paths)) + ' module(s) with ' + str(jobs) + ' job(s)...')
+	start = time.perf_counter()
+	results = []
+	if jobs <= 1:
+		for path in paths:
+			results.append(convert_batch_module(path, args, defaults))
+			print(results[-1][4], end='')
+	else:
+		# A worker that dies breaks the pool and every module still in it, so those are converted again,
+		# each in a pool of its own, and only the ones whose worker dies again fail
+		broken = []
+		with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=process_context()) as executor:
+			futures = { executor.submit(convert_batch_module, path, args, defaults) : path for path in paths }
+			for future in concurrent.futures.as_completed(futures):
+				try:
+					results.append(future.result())
+				except concurrent.futures.process.BrokenProcessPool:
+					broken.append(futures[future])
+					continue
+				print(results[-1][4], end='')
+		with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+			for result in executor.map(lambda path: convert_batch_module_isolated(path, args, defaults), sorted(broken)):
+				results.append(result)
+				print(result[4], end='')
+	elapsed = time.perf_counter() - start
+	
+	results.sort()
+	failed = [r for r in results if r[1] is not None]
+	width = max(len(r[0]) for r in results)
+	print()
+	print('Module'.ljust(width) + '   Time (s)    CPU (s)  Result')
+	for path, error, seconds, cpu, log in results:
+		print(path.ljust(width) + ' %10.2f %10.2f  ' % (seconds, cpu) + ('ok' if error is None else 'FAILED: ' + error))
+	print('%d converted, %d failed in %.2f s' % (len(results) - len(failed), len(failed), elapsed))
+	if len(failed) > 0:
+		sys.exit(1)
+		
+def convert_batch_module_isolated(path, args, defaults):
+	# convert_batch_module() in a process of its own, so a crash only fails this module
+	start = time.perf_counter()
+	with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=process_context()) as executor:
+		try:
+			return executor.submit(convert_batch_module, path, args, defaults).result()
+		except concurrent.futures.process.BrokenProcessPool:
+			error = 'the worker process died'
+			return path, error, time.perf_counter() - start, 0.0, '== ' + path + '\nError: ' + error + '\n'
+	
+def process_context():
+	# For process pools, which can start while other threads run (the background sample stage, the
+	# batch retries). Forking a process with threads can deadlock on a lock one of them held, so
+	# workers are forked from a forkserver that has it2amk and sampconv loaded, or spawned on Windows.
+	if 'forkserver' not in multiprocessing.get_all_start_methods():
+		return multiprocessing.get_context('spawn')
+	context = multiprocessing.get_context('forkserver')
+	context.set_forkserver_preload(['it2amk', 'sampconv'])
+	return context
+
+def convert_batch_module(path, args, defaults):
+	# Returns (path, error message or None, seconds, CPU seconds, log). Nothing a module does gets
+	# past here, so one broken module doesn't stop the rest of the batch.
+	log = io.StringIO()
+	error = None
+	start = time.perf_counter()
+	cpu_start = time.process_time()
+	with contextlib.redirect_stdout(log):
+		print('== ' + path)
+		try:
+			convert_module(path, args, copy.deepcopy(defaults))
+		except CompileErrorException as e:
+			error = str(e)
+		except SystemExit:
+			error = 'aborted'
+		except Exception as e:
+			error = type(e).__name__ + ': ' + str(e)
+		if error is not None:
+			print('Error:', error)
+	return path, error, time.perf_counter() - start, time.process_time() - cpu_start, log.getvalue()
+
+def watch_main():
+	if len(sys.argv) < 3 or len(sys.argv) % 2 != 1:
+		print('Error: Missing flag argument.' if len(sys.argv) >= 3 else 'Usage: python it2amk.py --watch <module_file> <flags>')
+		sys.exit(1)
+		
+	watcher = Watcher(sys.argv[2], sys.argv[3:])
+	print('Watching "' + watcher.module_path + '", press Ctrl+C to stop.')
+	stamp = None
+	try:
+		while True:
+			new_stamp = get_file_stamp(watcher.module_path)
+			if new_stamp is not None and new_stamp != stamp:
+				time.sleep(0.05) # Let the tracker finish saving
+				if get_file_stamp(watcher.module_path) == new_stamp:
+					stamp = new_stamp
+					watcher.convert()
+			time.sleep(0.2)
+	except KeyboardInterrupt:
+		pass
+		
+def get_file_stamp(path):
+	# (modification time, size), or None while the file is missing (editors that save by deleting and
+	# rewriting it leave it missing for a moment)
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	return st.st_mtime_ns, st.st_size
+	
+class Watcher:
+	# Reconverts a module after each save, redoing only the stages its changes affect
+	def __init__(self, module_path, args):
+		self.module_path = module_path
+		self.args = args
+		self.event_key = None
+		self.event_table = None
+		
+	def convert(self):
+		start = time.perf_counter()
+		try:
+			it = pyIT.ITfile()
+			it.open(self.module_path)
+		except (OSError, AssertionError, struct.error, UnicodeDecodeError) as e:
+			print('Error: Couldn\'t read the module (' + str(e) + ').')
+			return
+			
+		try:
+			check_samples(it)
+			config = Config()
+			config.get_module_flags(it)
+			for i in range(0, len(self.args), 2):
+				config.set_flag(self.args[i], self.args[i + 1])
+				
+			# Traversal reads the song, the instruments, a few sample header fields and the flags
+			event_key = pickle.dumps(({k: v for k, v in vars(it).items() if k not in ('Samples', 'Instruments', 'Message')},
+			                          it.Instruments, [(smp.Vol, smp.DfP, smp.GvL, smp.SampleName, smp.Filename) for smp in it.Samples],
+			                          config.flags))
+			if event_key == self.event_key:
+				evtbl = copy.copy(self.event_table)
+				evtbl.module, evtbl.config = it, config
+				evtbl.update_sample_tunings(self.event_table)
+			else:
+				evtbl = EventTable(it, config, self.module_path, previous=self.event_table)
+			if evtbl.sample_key is None:
+				evtbl.sample_key = evtbl.get_sample_key() # For comparing against next time
+			mml = MML(evtbl)
+			mml.save('music/' + self.module_path.split('.')[0].replace('\\', '/').split('/')[-1] + '.txt')
+			for message in evtbl.messages:
+				print(message)
+		except ValueError as e:
+			print('Error: ' + str(e))
+			return
+		except CompileErrorException as e:
+			print('Error:', e)
+			return
+			
+		reused = []
+		if event_key == self.event_key:
+			reused.append('events')
+		if self.event_table is not None and evtbl.sample_dict is self.event_table.sample_dict:
+			reused.append('samples')
+		self.event_key, self.event_table = event_key, evtbl
+		print(time.strftime('%H:%M:%S') + ' Converted in %.2f s' % (time.perf_counter() - start) + (' (reused ' + ' and '.join(reused) + ')' if reused else ''))
 
 def get_previous_module():
 	with open(previous_textfile_filename, "r") as file:
@@ -81,7 +448,8 @@ class CompileErrorException(Exception):
     pass
 
 class Config:
-	flags = {
+	# Defaults for every conversion; each Config instance gets its own copy
+	default_flags = {
 		'nosmpl' : [False, 'bool'],			# Skip the sample conversion phase
 		'addmml' : [[], None],				# List of MML snippets to add
 		'game' : ['', 'string'],			# Game title
@@ -102,7 +470,18 @@ class Config:
 		'amplify' : [0.92, 'real'],			# Constant amplify ratio across all samples
 		'echo' : ['', 'hex', 8],			# Echo parameters
 		'fir' : ['', 'hex', 16],			# Fir parameters
-		'master' : ['', 'hex', 4]			# Master level (left and right)
+		'master' : ['', 'hex', 4],			# Master level (left and right)
+		'cjobs' : [1, 'int'],				# Number of processes generating channel MML (1 = serial)
+		'notelen' : [False, 'bool'],		# Write note lengths (c8.) instead of tick lengths (c=36) where possible
+		'encoder' : ['native', 'string'],	# native (in-process BRR encoder) or sampconv (sampconv.exe + brr_encoder.exe)
+		'brrbeam' : [1, 'int'],				# Native BRR encoder beam width (1 = best filter per block)
+		'brrfast' : [False, 'bool'],		# Pick BRR filters from estimates instead of searching them all (faster, a little noisier)
+		'sjobs' : [0, 'int'],				# Number of processes converting samples (0 = one per CPU core, 1 = serial)
+		'cache' : ['cache', 'string'],		# Folder to cache converted samples in
+		'cachesize' : [256, 'int'],			# Cache size limit in MB (0 = no cache)
+		'arambudget' : [0, 'int'],			# Lower resample ratios until the samples fit in this many bytes (0 = off)
+		'resampler' : ['cubic', 'string'],	# Native resampler: nearest, linear, cubic or sinc
+		'truncate' : [False, 'bool']		# Cut off the parts of samples that notes never reach
 	}
 	flag_aliases = {
 		'ns' : 'nosmpl',
@@ -125,15 +504,27 @@ class Config:
 		'a' : 'amplify',
 		'e' : 'echo',
 		'f' : 'fir',
-		'ml' : 'master'
+		'ml' : 'master',
+		'cj' : 'cjobs',
+		'nl' : 'notelen',
+		'en' : 'encoder',
+		'bb' : 'brrbeam',
+		'bf' : 'brrfast',
+		'sj' : 'sjobs',
+		'ca' : 'cache',
+		'cs' : 'cachesize',
+		'ab' : 'arambudget',
+		'rs' : 'resampler',
+		'tr' : 'truncate'
 	}
 	
-	@staticmethod
-	def flag(f):
-		return Config.flags[f][0]
+	def __init__(self):
+		self.flags = copy.deepcopy(Config.default_flags)
+		
+	def flag(self, f):
+		return self.flags[f][0]
 		
-	@staticmethod
-	def set_flag(flag, value):
+	def set_flag(self, flag, value):
 		if flag.startswith('--') and len(flag) >= 3 and flag[2] != '-':
 			flag = flag[2:]
 	
@@ -141,56 +532,55 @@ class Config:
 			if flag.startswith('-'):
 				flag = Config.flag_aliases[flag[1:]]
 		
-			if Config.flags[flag][1] == 'string':
-				Config.flags[flag][0] = value
-			elif Config.flags[flag][1] == 'time':
+			if self.flags[flag][1] == 'string':
+				self.flags[flag][0] = value
+			elif self.flags[flag][1] == 'time':
 				if re.match('^[0-9]+:[0-9]+$', value):
-					Config.flags[flag][0] = value
+					self.flags[flag][0] = value
 				else:
 					raise ValueError(flag + ' must be in the format m:ss.')
-			elif Config.flags[flag][1] == 'hex':
-				if re.match('^([0-9]|[A-F]|[a-f])+$', value) and (len(Config.flags[flag]) < 3 or len(value) >= Config.flags[flag][2]):
-					Config.flags[flag][0] = value
+			elif self.flags[flag][1] == 'hex':
+				if re.match('^([0-9]|[A-F]|[a-f])+$', value) and (len(self.flags[flag]) < 3 or len(value) >= self.flags[flag][2]):
+					self.flags[flag][0] = value
 				elif not re.match('^([0-9]|[A-F]|[a-f])+$', value):
 					raise ValueError(flag + ' must be a hexadecimal string.')
 				else:
 					raise ValueError(flag + ': "' + value + '" is too short.')
-			elif Config.flags[flag][1] == 'int':
+			elif self.flags[flag][1] == 'int':
 				try:
-					Config.flags[flag][0] = int(value)
+					self.flags[flag][0] = int(value)
 				except ValueError:
 					raise ValueError(flag + ' must be an integer.')
-			elif Config.flags[flag][1] == 'real':
+			elif self.flags[flag][1] == 'real':
 				try:
-					Config.flags[flag][0] = float(value)
+					self.flags[flag][0] = float(value)
 				except ValueError:
 					raise ValueError(flag + ' must be a real number.')
-			elif Config.flags[flag][1] == 'bool':
+			elif self.flags[flag][1] == 'bool':
 				if value.lower() == 'true':
-					Config.flags[flag][0] = True
+					self.flags[flag][0] = True
 				elif value.lower() == 'false':
-					Config.flags[flag][0] = False
+					self.flags[flag][0] = False
 				else:
 					raise ValueError(flag + ' must be true or false.')
 			else:
 				splits = value.split(':', 4)
-				Config.flags[flag][0].append([])
+				self.flags[flag][0].append([])
 				
-				Config.flags[flag][0][-1].append(0)
-				Config.flags[flag][0][-1].append(1)
-				Config.flags[flag][0][-1].append(0)
-				Config.flags[flag][0][-1].append(0)
-				Config.flags[flag][0][-1].append('')
+				self.flags[flag][0][-1].append(0)
+				self.flags[flag][0][-1].append(1)
+				self.flags[flag][0][-1].append(0)
+				self.flags[flag][0][-1].append(0)
+				self.flags[flag][0][-1].append('')
 				
 				for i in range(0, len(splits) - 1):
-					Config.flags[flag][0][-1][i] = int(splits[i])
-				Config.flags[flag][0][-1][-1] = splits[-1]
+					self.flags[flag][0][-1][i] = int(splits[i])
+				self.flags[flag][0][-1][-1] = splits[-1]
 				
 		except KeyError:
 			raise ValueError('Flag ' + flag + ' does not exist or is not supported in this version of it2amk.')
 
-	@staticmethod
-	def get_module_flags(it):
+	def get_module_flags(self, it):
 		flag_text = ''
 		interpret = False
 		for c in it.Message:
@@ -215,23 +605,13 @@ class Config:
 				
 		flags = flag_text_2.split()
 		if len(flags) % 2 != 0:
-			print('Error: Missing flag argument in module song message.')
-			sys.exit(1)
+			raise ValueError('Missing flag argument in module song message.')
 			
 		f = 0
 		while f < len(flags):
 			flag = flags[f].replace('\\s', ' ')
 			arg = flags[f + 1].replace('\\s', ' ')
-			
-			try:
-				Config.set_flag(flag, arg)
-			except ValueError as e:
-				print('Error: ' + str(e))
-				sys.exit(1)
-			except KeyError as e:
-				print('Error: ' + str(e))
-				sys.exit(1)
-			
+			self.set_flag(flag, arg)
 			f += 2
 			
 class EventState:
@@ -253,7 +633,18 @@ class Event:
 		self.visible = visible
 		
 class EventTable:
-	def __init__(self, module):
+	def __init__(self, module, config=None, module_path='', write_samples=True, previous=None, synchronous=False):
+		self.config = config if config is not None else Config()
+		self.module_path = module_path
+		self.write_samples = write_samples # Write the BRRs to samples/<song>; convert() keeps them in prepared_samples
+		self.synchronous = synchronous # Convert the samples on this thread instead of in the background
+		self.prepared_samples = []
+		self.previous = previous # The last conversion of this module in watch mode, whose tunings can be reused
+		self.sample_key = None
+		self.sample_future = None
+		self.max_lengths = None
+		self.messages = [] # Reports from the sample stage, printed once it's done
+		self.unused_samples = set()
 		self.events = [[], [], [], [], [], [], [], []]
 		self.g_events = []
 		self.module = module
@@ -264,8 +655,10 @@ class EventTable:
 		self.sample_dict = {}
 		self.ins_dict = {}
 		self.ins_list = []
+		self.ins_adsr = {}
 		self.loop_tick = 0
 		self.convert()
+		self.previous = None
 		
 	def get_ins_flags(self, c):
 		it_ins = self.states[c].state_d['@']
@@ -318,6 +711,22 @@ class EventTable:
 						
 		return flags
 		
+	def fit_ins_adsr(self):
+		# ADSR/gain bytes, release bytes (None if a key off stops the note) and ticks the release takes
+		# for every instrument in ins_list. The channels and truncate both read the release from here.
+		fitter = ADSRFitter(self.module.IT)
+		self.ins_adsr = {}
+		for ins, sample in self.ins_list:
+			if ins not in self.ins_adsr:
+				adsr, release = fitter.fit(self.module.Instruments[ins - 1], self.get_ins_flags_ins(ins))
+				self.ins_adsr[ins] = (adsr, release, fitter.get_release_ticks(release) if release is not None else 0)
+				
+	def get_ins_release(self, it_ins):
+		# What a key off switches the instrument to: the `r` flag, or the release fitted to its envelope
+		if it_ins in self.ins_adsr:
+			return self.ins_adsr[it_ins][1]
+		return self.get_ins_flags_ins(it_ins)['r']
+		
 	def get_samp_flags(self, it_samp):
 		flags = { '@':None, 'r':1.0, 'a':1.0 }
 		samp_name = self.module.Samples[it_samp - 1].SampleName + self.module.Samples[it_samp - 1].Filename
@@ -558,7 +967,7 @@ class EventTable:
 				if rr % self.module.PHilight_major == 0:
 					self.events[c].append(Event(basetick, 'bar', 0)) # mark newline for each measure
 		
-			for m in Config.flag('addmml'):
+			for m in self.config.flag('addmml'):
 				if m[0] == order and m[1] - 1 == c and m[2] == rr and m[3] == 0:
 					if iter == 0:
 						self.events[c].append(Event(basetick, 'mml', m[-1]))
@@ -615,7 +1024,7 @@ class EventTable:
 			# This particular loop is only for handling inserted mml.
 			# For Fade commands such as axx, use the range(subtick, speed) loop. (They respond to delay)
 			for tick in range(1, min(subtick + 1, speed)):
-				for m in Config.flag('addmml'):
+				for m in self.config.flag('addmml'):
 					if m[0] == order and m[1] - 1 == c and m[2] == rr and m[3] == tick:
 						if iter == 0:
 							self.events[c].append(Event(basetick + tick, 'mml', m[-1]))
@@ -711,7 +1120,7 @@ class EventTable:
 									self.ins_list.append((self.states[c].state_d['@'], 0))
 					
 				for tick in range(subtick + 1, speed):
-					for m in Config.flag('addmml'):
+					for m in self.config.flag('addmml'):
 						if m[0] == order and m[1] - 1 == c and m[2] == rr and m[3] == tick:
 							self.events[c].append(Event(basetick + tick, 'mml', m[-1]))
 						
@@ -728,10 +1137,59 @@ class EventTable:
 					if cuttick is not None and tick == cuttick:
 						self.add_note(r, c, basetick, tick, speed, 254)
 						
-	def get_sample_tunings(self, unused_samples):
-		if not Config.flag('nosmpl'):
+	@property
+	def sample_dict(self):
+		# The sample stage runs in the background until something needs the tunings
+		if self.sample_future is not None:
+			future, self.sample_future = self.sample_future, None
+			self._sample_dict = future.result()
+		return self._sample_dict
+		
+	@sample_dict.setter
+	def sample_dict(self, value):
+		self.sample_future = None
+		self._sample_dict = value
+		
+	def __getstate__(self):
+		# The cjobs workers only need the events
+		state = dict(self.__dict__)
+		state.update({ 'sample_future' : None, '_sample_dict' : {}, 'prepared_samples' : [], 'previous' : None })
+		return state
+		
+	def update_sample_tunings(self, previous=None):
+		# Start converting the samples, or in watch mode keep the last conversion's tunings if nothing
+		# the sample stage reads has changed. How far notes reach into the samples is worked out here,
+		# before MML can change the instruments, and only the result goes to the background thread.
+		self.max_lengths = self.get_max_lengths() if self.config.flag('truncate') else None
+		self.messages = []
+		key = self.get_sample_key() if previous is not None else None
+		if key is not None and key == previous.sample_key:
+			self.sample_dict, self.prepared_samples, self.messages = previous.sample_dict, previous.prepared_samples, previous.messages
+		elif self.synchronous:
+			self.sample_dict = self.get_sample_tunings(self.unused_samples, self.max_lengths)
+		else:
+			executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+			future = executor.submit(self.get_sample_tunings, self.unused_samples, self.max_lengths)
+			executor.shutdown(wait=False)
+			self.sample_future = future
+		self.sample_key = key
+		
+	def get_sample_key(self):
+		# Everything the sample stage depends on: the samples themselves, which ones are used and how
+		# often (for arambudget), how far notes reach into them (for truncate) and the flags
+		return (hashlib.sha1(pickle.dumps(self.module.Samples)).digest(), frozenset(self.used_samples), tuple(self.ins_list),
+		        self.max_lengths, pickle.dumps(self.config.flags))
+		
+	def get_sample_tunings(self, unused_samples, max_lengths=None):
+		if self.config.flag('encoder') == 'native':
+			return self.convert_samples(max_lengths)
+		elif self.config.flag('encoder') != 'sampconv':
+			raise CompileErrorException('Invalid encoder "' + self.config.flag('encoder') + '".')
+			
+		lines = []
+		if not self.config.flag('nosmpl'):
 			try:
-				os.remove('temp/tunings.txt')
+				os.remove('temp/tunings.txt') # So an old build's file from an earlier run can't be mistaken for this one's
 			except OSError:
 				pass
 				
@@ -743,23 +1201,237 @@ class EventTable:
 				else:
 					use_string += '0'
 					
-			arg_list = ['sampconv.exe', module_path, use_string]
+			arg_list = ['sampconv.exe', self.module_path, use_string]
 			
 			# Add resample and amplify ratios
+			resample_ratios, amplify_ratios = self.get_sample_ratios()
 			for s in range(0, len(self.module.Samples)):
-				arg_list.append(str(Config.flag('resample')))
-				arg_list.append(str(Config.flag('amplify')))
+				arg_list.append(str(resample_ratios[s]))
+				arg_list.append(str(amplify_ratios[s]))
 				
 			#print('arg_list', arg_list)
 				
-			subprocess.call(arg_list)
-		
-		with open('temp/tunings.txt', 'r') as file: #If the temp folder doesn't exist, it errors out here.
-			lines = file.readlines()
-
+			# sampconv.exe prints its tunings as 'tuning "<file>" $XXXX' lines among its log output
+			try:
+				output = subprocess.run(arg_list, stdout=subprocess.PIPE, universal_newlines=True).stdout
+			except OSError as e:
+				raise CompileErrorException('Couldn\'t run sampconv.exe (' + str(e) + ').')
+			for line in output.splitlines():
+				if line.startswith('tuning '):
+					lines.append(line[7:])
+				else:
+					print(line)
+					
+		if len(lines) == 0:
+			# Builds of sampconv.exe from before the stdout tunings wrote them to temp/tunings.txt instead
+			try:
+				with open('temp/tunings.txt', 'r') as file:
+					lines = file.readlines()
+			except OSError:
+				pass
+		tunings = list(parse_tunings(lines))
 		used_list = sorted(list(self.used_samples))
+		if len(tunings) == 0 and len(used_list) > 0:
+			raise CompileErrorException('sampconv.exe didn\'t report any sample tunings.')
+		elif len(tunings) != len(used_list):
+			raise CompileErrorException('sampconv.exe reported ' + str(len(tunings)) + ' sample tunings for the ' + str(len(used_list)) + ' samples the module uses.')
+			
 		sample_dict = {}
 		
+		for used_index, (sample_name, tuning) in enumerate(tunings):
+			sample_dict[used_list[used_index]] = (self.get_sample_name(used_list[used_index], sample_name), tuning)
+			
+		return sample_dict
+		
+	def convert_samples(self, max_lengths=None):
+		import brrcache
+		import sampconv # Only the native encoder needs numpy
+		
+		cache = None
+		if self.config.flag('cachesize') > 0:
+			cache = brrcache.BRRCache(self.config.flag('cache'), self.config.flag('cachesize') * 1024 * 1024)
+			
+		if self.config.flag('resampler') not in sampconv.resampler.resamplers:
+			raise CompileErrorException('Invalid resampler "' + self.config.flag('resampler') + '".')
+			
+		resample_ratios, amplify_ratios = self.get_sample_ratios(max_lengths)
+		if max_lengths is not None:
+			self.report_truncation(max_lengths, resample_ratios)
+		try:
+			prepared = sampconv.convert_samples(self.module, self.used_samples, resample_ratios, amplify_ratios, not self.config.flag('nosmpl'),
+			                                    self.config.flag('brrbeam'), self.config.flag('sjobs'), cache, self.config.flag('resampler'), max_lengths,
+			                                    self.config.flag('brrfast'), process_context())
+		except sampconv.SampleError as e:
+			raise CompileErrorException(str(e))
+			
+		self.prepared_samples = prepared
+		if self.write_samples and not self.config.flag('nosmpl'):
+			sampconv.write_samples('samples/' + self.module_path.split('.')[0].replace('\\', '/').split('/')[-1], prepared)
+		if cache is not None:
+			cache.evict()
+			
+		duplicates = [p for p in prepared if p.shared is not None]
+		if len(duplicates) > 0:
+			self.messages.append('Shared ' + str(len(duplicates)) + ' duplicate sample(s), saving ' + str(sum(p.size for p in duplicates)) + ' bytes of BRR data.')
+			
+		sample_dict = {}
+		for p in prepared:
+			sample_dict[p.index] = (self.get_sample_name(p.index, p.filename), p.tuning)
+		return sample_dict
+		
+	def get_sample_ratios(self, max_lengths=None):
+		# Resample and amplify ratios for every sample: the global flags times the sample's `r` and `a`
+		resample_ratios = [self.config.flag('resample')] * len(self.module.Samples)
+		amplify_ratios = [self.config.flag('amplify')] * len(self.module.Samples)
+		for s in sorted(self.used_samples):
+			flags = self.get_samp_flags(s)
+			resample_ratios[s - 1] *= float(flags['r'])
+			amplify_ratios[s - 1] *= float(flags['a'])
+			if not 0 < resample_ratios[s - 1] < math.inf:
+				raise CompileErrorException('Sample ' + str(s) + ': The resample ratio (the resample flag times `r`) is ' +
+				                            str(resample_ratios[s - 1]) + ', but it has to be a number above 0.')
+			
+		if self.config.flag('arambudget') > 0:
+			self.fit_aram_budget(resample_ratios, max_lengths)
+		return resample_ratios, amplify_ratios
+		
+	def fit_aram_budget(self, resample_ratios, max_lengths=None):
+		# Lower the resample ratios of the samples that end up in #samples so they fit the budget
+		budget = self.config.flag('arambudget')
+		samples = sorted(s for s in self.used_samples if self.get_samp_flags(s)['@'] is None)
+		if len(samples) == 0:
+			return
+		lengths = [aram.source_length(self.module.Samples[s - 1], max_lengths[s - 1] if max_lengths else None) for s in samples]
+		uses = [max(1, sum(1 for i in self.ins_list if i[1] == s)) for s in samples]
+		max_ratios = [resample_ratios[s - 1] for s in samples]
+		
+		ratios = aram.solve_ratios(lengths, uses, max_ratios, budget)
+		self.messages.append(aram.format_report(budget, list(zip(samples, lengths, uses, max_ratios, ratios))))
+		for s, r in zip(samples, ratios):
+			resample_ratios[s - 1] = r
+		
+	def get_max_lengths(self):
+		"""
+		For truncate: the most frames of each used sample that a note can play, from how long notes
+		sound (until the next note or cut, or the end of the release after a key off, with legato tying
+		notes together), the volume envelope and fadeout, and the pitch they play at. None where a note
+		can sound forever.
+		"""
+		tempos = sorted((e.tick, e.value) for events in self.events for e in events if e.effect == 'T')
+		if len(tempos) == 0 or tempos[0][0] > 0:
+			tempos.insert(0, (0, self.module.IT))
+		tempo_ticks = [t[0] for t in tempos]
+		tempo_times = [0.0]
+		for i in range(1, len(tempos)):
+			tempo_times.append(tempo_times[-1] + (tempos[i][0] - tempos[i - 1][0]) * 2.5 / tempos[i - 1][1])
+			
+		def time(tick):
+			i = max(bisect.bisect_right(tempo_ticks, tick) - 1, 0)
+			return tempo_times[i] + (tick - tempo_ticks[i]) * 2.5 / tempos[i][1]
+			
+		end_tick = max(e.tick for events in self.events for e in events)
+		span = end_tick - self.loop_tick
+		def time_wrapped(tick):
+			# Ticks past the end continue from the loop point
+			if tick <= end_tick:
+				return time(tick)
+			return time(end_tick) + time(tick - span) - time(self.loop_tick)
+			
+		max_lengths = {}
+		def finish(chain, forever=False):
+			for s in chain['samples']:
+				if forever or max_lengths.get(s, 0) is None:
+					max_lengths[s] = None
+				else:
+					max_lengths[s] = max(max_lengths.get(s, 0), chain['frames'])
+					
+		for c in range(0, 8):
+			events = [e for e in self.events[c] if e.effect in ('', '@')]
+			loop_start = len(events)
+			for e in range(0, len(events)):
+				if events[e].tick >= self.loop_tick:
+					loop_start = e
+					break
+					
+			ins, chain, wrapped, e = None, None, False, 0
+			while True:
+				if e == len(events):
+					if chain is None:
+						break
+					elif wrapped or loop_start == len(events):
+						finish(chain, True)
+						break
+					wrapped, e = True, loop_start
+					continue
+					
+				event = events[e]
+				e += 1
+				if event.effect == '@' or ins is None:
+					ins = event.value if event.effect == '@' else ins
+					continue
+				tick = event.tick + (span if wrapped else 0)
+				
+				if chain is not None: # Frames played since the last pitch change
+					end = min(tick, chain['silent'])
+					if end > chain['start']:
+						chain['frames'] += (time_wrapped(end) - time_wrapped(chain['start'])) * chain['rate']
+					chain['start'] = tick
+					
+				if event.value < 120 and not self.get_ins_flags_ins(ins)['n']:
+					sample = self.get_sample(ins, event.value)
+					rate = self.module.Samples[sample - 1].C5Speed * 2 ** ((self.module.Instruments[ins - 1].SampleTable[event.value][0] - 60) / 12)
+					if chain is not None and self.config.flag('legato'):
+						chain['samples'].add(sample)
+						chain['rate'] = rate
+						continue
+					elif chain is not None:
+						finish(chain)
+					if wrapped:
+						break
+					chain = { 'samples': {sample}, 'frames': 0.0, 'start': tick, 'rate': rate, 'silent': tick + self.get_silent_ticks(ins)[0] }
+				elif event.value == 255 and chain is not None and self.get_ins_release(ins) is not None:
+					if chain['silent'] > tick: # Released, and sounding until the release envelope ends
+						chain['silent'] = tick + self.ins_adsr.get(ins, (None, None, float('inf')))[2]
+				elif event.value == 246 and chain is not None:
+					chain['silent'] = min(chain['silent'], tick + self.get_silent_ticks(ins)[1]) # Fading, but still sounding
+				elif chain is not None:
+					finish(chain)
+					chain = None
+					if wrapped:
+						break
+						
+		# Some room for vibrato and the resampler's taps
+		return [None if max_lengths.get(s + 1) is None else int(max_lengths[s + 1] * 1.03) + 64 for s in range(0, len(self.module.Samples))]
+		
+	def get_silent_ticks(self, ins):
+		# (ticks from a note's start, ticks from its release) until the instrument is silent for good
+		inf = float('inf')
+		env = self.module.Instruments[ins - 1].volEnv
+		fadeout = self.module.Instruments[ins - 1].FadeOut
+		release = 1024 / fadeout if fadeout > 0 else inf
+		if not env.IsOn or env.LoopOn or self.get_ins_flags_ins(ins)['a'] is not None:
+			return inf, release
+			
+		nodes = env.Nodes[:env.numNodePoints]
+		if len(nodes) == 0 or nodes[-1].y_val != 0:
+			return inf, release
+		last = max([n for n in range(0, len(nodes)) if nodes[n].y_val > 0], default=-1)
+		silent = nodes[last + 1].tick if last >= 0 else 0
+		if env.SusloopOn: # Held at the sustain loop until released
+			return inf, min(max(silent - nodes[env.SLB].tick, 0), release)
+		return silent, min(silent, release)
+		
+	def report_truncation(self, max_lengths, resample_ratios):
+		for s in sorted(self.used_samples):
+			it_sample = self.module.Samples[s - 1]
+			length, loop_start = aram.source_length(it_sample)
+			new_length, new_loop_start = aram.source_length(it_sample, max_lengths[s - 1])
+			if new_length < length:
+				saved = aram.projected_size(length, loop_start, resample_ratios[s - 1]) - aram.projected_size(new_length, new_loop_start, resample_ratios[s - 1])
+				self.messages.append('Sample ' + str(s) + ': truncated from ' + str(length) + ' to ' + str(new_length) + ' samples, saving about ' + str(saved) + ' bytes.')
+				
+	def get_sample_name(self, it_samp, sample_name):
+		# Apply the `@` default sample override
 		default_dict = { 0: '00 SMW @0', 1: '01 SMW @1', 2: '02 SMW @2', 3: '03 SMW @3',
 			4: '04 SMW @4', 5: '07 SMW @5', 6: '08 SMW @6', 7: '09 SMW @7',
 			8: '05 SMW @8', 9: '0A SMW @9', 10: '0B SMW @10', 11: '01 SMW @1',
@@ -769,39 +1441,16 @@ class EventTable:
 			26: '0B SMW @10', 27: '0B SMW @10', 28: '0B SMW @10', 29: '0E SMW @29'
 		}
 		
-		used_index = 0
-		
-		for line in lines:
-			nline = ''
-			quote = False
-			for c in line:
-				if c == '"':
-					quote = not quote
-				elif quote and c == ' ':
-					nline += '\\s'
-				elif c != '\n' and c != '\r':
-					nline += c
-			#print(nline)
-			args = nline.split(' ')
-			sample_name = args[0].replace('\\s', ' ')
-			tuning = args[1][:3] + ' $' + args[1][3:]
-			
-			flags = self.get_samp_flags(used_list[used_index])
-			#print('sflags:', used_list[used_index], '-', sample_name, flags)
-			default_prefix = '../default/'
-			
-			override = flags['@']
-			if override is not None:
-				if int(override) in default_dict:
-					sample_name = default_prefix + default_dict[int(override)] + '.brr'
-				else:
-					sample_name = default_prefix + '13 SMW Thunder.brr'
-			
-			sample_dict[used_list[used_index]] = (sample_name, tuning)
-			
-			used_index += 1
-			
-		return sample_dict
+		flags = self.get_samp_flags(it_samp)
+		default_prefix = '../default/'
+		
+		override = flags['@']
+		if override is not None:
+			if int(override) in default_dict:
+				sample_name = default_prefix + default_dict[int(override)] + '.brr'
+			else:
+				sample_name = default_prefix + '13 SMW Thunder.brr'
+		return sample_name
 		
 	def fix_global_events(self):
 		self.g_events.sort(key=operator.attrgetter('tick'))
@@ -917,10 +1566,6 @@ class EventTable:
 		#print('Unused samples:', unused_samples)
 		#print('Loop position, Loop row: ', (loop_pos, loop_row))
 		
-		tunings = self.get_sample_tunings(unused_samples)
-		self.sample_dict = tunings
-		#print(self.sample_dict)
-					
 		for c in range(0, 8):
 			self.events[c].append(Event(tick, 'end', 0))
 			
@@ -955,62 +1600,123 @@ class EventTable:
 					if self.events[c][e].tick >= self.loop_tick:
 						self.events[c].insert(e, Event(tick, 'loop', 0))
 						break
-		
-		txt = ''
-		for c in range(0, 8):
-			txt = ''.join((txt, '#' + str(c) + '\n'))
-			for e in self.events[c]:
-				txt = ''.join((txt, '    ' + str((e.tick, e.effect, e.value)) + '\n'))
-		#with open("event_table.txt", 'w') as file:
-			#file.write(txt)
-
-class MMLState:
-	def __init__(self):
-		self.state_d = { 'o':None, 'h':0, 'v':None, 'q':None, \
-						'tune':0x00, 'y':(10, 0, 0), 'p':(0, 0, 0), 'trem':(0, 0, 0), \
-						'echo':0x00, '@':0, 'dgain':None, 'note':None, \
-						'echof':False, 'n':None, 'amp':0x00, 'gain':None }
-		self.hstate_d = { '':None, 'M':None, 'S':0x90, 'X':0x80, \
-						'E':0x00, 'H':0x00, 'I':0x00, 'J':0x00, \
-						'Q':0x00, 'R':0x00, 'v':None, '@':None, \
-						'IV':None, 'SV':None, 'EV':None, 'EX':None, 'EE':None, 'H':0x00,
-						'Z1':None }
 						
-class MML:
-	def __init__(self, event_table):
-		self.txt = ''
-		self.event_table = event_table
-		self.states = [MMLState(), MMLState(), MMLState(), MMLState(), \
-						MMLState(), MMLState(), MMLState(), MMLState()]
-		self.g_state = { 'evoll':0, 'evolr':0 }
-		self.echo_set = False
-		
-		self.adsr_rates = [ \
-			0, 2048, 1536, 1280, \
-			1024, 768, 640, 512, \
-			384, 320, 256, 192, \
-			160, 128, 96, 80, \
-			64, 48, 40, 32, \
-			24, 20, 16, 12, \
-			10, 8, 6, 5, \
-			4, 3, 2, 1 \
-		]
+		self.unused_samples = unused_samples
+		self.fit_ins_adsr()
+		self.update_sample_tunings(self.previous) # After the loop point and the ADSR fits, which truncate needs
+		#print(self.sample_dict)
 
-		self.sus_levels = [ 0x100, 0x200, 0x300, 0x400, 0x500, 0x600, 0x700, 0x800 ]
-		
+def parse_tunings(lines):
+	# sampconv.exe tuning lines look like '"01 name.brr" $035E'; yields ('01 name.brr', '$03 $5E')
+	for line in lines:
+		m = re.match('^"(.*)" (\\$[0-9A-Fa-f]{4})\\s*$', line)
+		if m:
+			yield m.group(1), m.group(2)[:3] + ' $' + m.group(2)[3:]
+
+def calc_v_level(v):
+	vv = (v * 0xFF) >> 8
+	vv = (vv * vv) >> 8
+	vv = (vv * 0x51) >> 8
+	vv = (vv * 0xFC) >> 8
+	return vv * 0xFF / 0x4D
+	
+v_levels = [calc_v_level(v) for v in range(0, 256)] # Non-decreasing in v
+
+def search_v(level):
+	# Closest v for a linear level. Ties go to the highest v, like the old linear scan did
+	i = bisect.bisect_right(v_levels, level)
+	minval, mindiff = -1, 256
+	if i > 0 and abs(v_levels[i - 1] - level) <= mindiff:
+		minval, mindiff = i - 1, abs(v_levels[i - 1] - level)
+	if i < len(v_levels) and abs(v_levels[i] - level) <= mindiff:
+		minval = bisect.bisect_right(v_levels, v_levels[i]) - 1
+	return minval
+	
+v_table = [0] + [search_v(l) for l in range(1, 256)] # find_v for every integer level
+
+smw_pan_tbl = [0x00, 0x01, 0x03, 0x07, 0x0D, 0x15, 0x1E, 0x29, 0x34, 0x42,
+               0x51, 0x5E, 0x67, 0x6E, 0x73, 0x77, 0x7A, 0x7C, 0x7D, 0x7E, 0x7F]
+
+def calc_pan(it_pan, panning):
+	# Base y value and volume normalizer for a 0-255 pan (0xFF - IT pan)
+	base_pan, rnorm = None, None
+	if panning == 'linear':
+		base_pan = int(round(it_pan * 20.0/255.0))
+		rnorm = 254.0 / (smw_pan_tbl[base_pan] + smw_pan_tbl[20 - base_pan])
+	elif panning == 'accurate':
+		lvol = max(it_pan, 1) - 0x01
+		rvol = 0xFF - max(it_pan, 1)
+		
+		diff = 1000000
+		for p in range(len(smw_pan_tbl)):
+			plvol = smw_pan_tbl[p]
+			prvol = smw_pan_tbl[20 - p]
+			sum = plvol + prvol
+			norm = 254.0 / sum
+			
+			plvol *= norm
+			prvol *= norm
+			
+			tdiff = abs(plvol - lvol) + abs(prvol - rvol)
+			
+			if tdiff < diff:
+				base_pan = p
+				diff = tdiff
+				rnorm = norm
+				
+	return base_pan, rnorm
+	
+def calc_pan_table(panning, surround, invert):
+	table = []
+	for it_pan in range(0, 256):
+		if not surround:
+			base_pan, rnorm = calc_pan(it_pan, panning)
+			table.append(((base_pan, 0, 0) if not invert else (base_pan, 1, 1), rnorm / 2.0))
+		else:
+			table.append(((10, 1, 0) if not invert else (10, 0, 1), 1))
+	return table
+	
+# (panning, surround, invert) -> calc_y result for every pan value
+pan_tables = { (p, s, i): calc_pan_table(p, s, i) for p in ('accurate', 'linear') for s in (False, True) for i in (False, True) }
+
+# AMK note length tokens by length in ticks (a whole note is 192 ticks). Plain lengths win over dotted ones.
+note_lengths = {}
+for n in (1, 2, 4, 8, 16, 32, 64):
+	note_lengths[192 * 3 // (2 * n)] = str(n) + '.'
+for n in (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64, 96, 192):
+	note_lengths[192 // n] = str(n)
+
+adsr_caches = {} # Tempo -> (ds_cache, sr_cache, dsr_cache) for ADSRFitter.init_adsr_caches
+adsr_fits = {} # (tempo, volume envelope) -> (a, d, s, r, rr) fitted by ADSRFitter.fit
+
+class ADSRFitter:
+	# Fits SNES ADSR envelopes to IT volume envelopes at one tempo
+	adsr_rates = [ \
+		0, 2048, 1536, 1280, \
+		1024, 768, 640, 512, \
+		384, 320, 256, 192, \
+		160, 128, 96, 80, \
+		64, 48, 40, 32, \
+		24, 20, 16, 12, \
+		10, 8, 6, 5, \
+		4, 3, 2, 1 \
+	]
+	
+	sus_levels = [ 0x100, 0x200, 0x300, 0x400, 0x500, 0x600, 0x700, 0x800 ]
+	
+	def __init__(self, tempo):
+		self.tempo = tempo
 		self.ds_cache = {}
 		self.sr_cache = {}
 		self.dsr_cache = {}
-		
-		self.add_amk_header()
-		self.add_spc_info()
-		self.add_sample_info()
-		self.add_ins_info()
-		self.add_init_info()
-		
-		self.convert()
+		self.init_adsr_caches(tempo)
 		
 	def init_adsr_caches(self, tempo):
+		# The tables only depend on the tempo, so they're shared by every conversion in the process
+		if tempo in adsr_caches:
+			self.ds_cache, self.sr_cache, self.dsr_cache = adsr_caches[tempo]
+			return
+			
 		for d in range(0, 8):
 			for s in range(0, 8):
 				self.ds_cache[(d, s)] = len(self.calc_decay_table(d, s, tempo))
@@ -1023,59 +1729,8 @@ class MML:
 			for s in range(0, 8):
 				for r in range(0, 32):
 					self.dsr_cache[(d, s, r)] = self.ds_cache[(d, s)] + self.sr_cache[(s, r)] - 1
+		adsr_caches[tempo] = (self.ds_cache, self.sr_cache, self.dsr_cache)
 		
-	def add_amk_header(self):
-		self.txt = ''.join(('#amk 2\n\n', self.txt))
-		
-	def add_spc_info(self):
-		spc_text = '#SPC\n{\n'
-		add_spc_header = False
-		
-		if self.event_table.module.SongName != '':
-			add_spc_header = True
-			title = self.event_table.module.SongName.replace('\r', '').replace('\n', ' ').replace('"', "'")
-			spc_text += '    #title   "' + title + '"\n'
-		if Config.flag('game') != '':
-			add_spc_header = True
-			spc_text += '    #game    "' + Config.flag('game').replace('\r', '').replace('\n', ' ').replace('"', "'") + '"\n'
-		if Config.flag('author') != '':
-			add_spc_header = True
-			spc_text += '    #author  "' + Config.flag('author').replace('\r', '').replace('\n', ' ').replace('"', "'") + '"\n'
-		if Config.flag('length') != '':
-			add_spc_header = True
-			spc_text += '    #length  "' + Config.flag('length').replace('\r', '').replace('\n', ' ').replace('"', "'") + '"\n'
-		if self.event_table.module.Message != '':
-			add_spc_header = True
-			msg = self.event_table.module.Message.replace('\r', '').replace('\n', ' ').replace('"', "'")
-			msg2 = ''
-			interpret = False
-			for c in msg:
-				if c == '`':
-					interpret = not interpret
-				elif not interpret:
-					msg2 = ''.join((msg2, c))
-			spc_text += '    #comment "' + msg2.strip() + '"\n'
-			
-		spc_text += '}\n\n'
-		
-		if add_spc_header:
-			self.txt = ''.join((self.txt, spc_text))
-			
-	def add_sample_info(self):
-		path = module_path.replace('\\', '/').split('/')[-1].split('.')[0]
-		sample_text = '#path ' + '"' + path + '"' + '\n\n' + '#samples\n{\n'
-		add_sample_header = False
-		
-		for k in self.event_table.sample_dict:
-			add_sample_header = True
-			sample_name = self.event_table.sample_dict[k][0]
-			sample_text += '    ' + '"' + sample_name + '"' + '\n'
-			
-		sample_text += '}\n\n'
-		
-		if add_sample_header:
-			self.txt = ''.join((self.txt, sample_text))
-			
 	def calc_env_table(self, env):
 		envtable, loop_end = [], None
 		tick = 0
@@ -1291,17 +1946,166 @@ class MML:
 			
 			return d, s, r, None
 			
-	def add_ins_info(self):
+	def fit(self, instrument, flags):
+		# (adsr, release) for an instrument with the given flags: its ADSR/gain bytes, from the `a` flag
+		# or fitted to the volume envelope, and the bytes a key off switches to, from the `r` flag or
+		# fitted to the envelope after its sustain loop (None if a key off just stops the note)
+		tempo = self.tempo
+		flags_a, flags_r = flags['a'], flags['r']
+		
+		if flags_a is None:
+			if not instrument.volEnv.IsOn:
+				flags_a = '00007F'
+			else:
+				a, d, s, r = 0xF, 0x7, 0x7, 0x0
+				env = instrument.volEnv
+				key = (tempo, env.LoopOn, env.SusloopOn, env.LpB, env.LpE, env.SLB, env.SLE, env.numNodePoints,
+				       tuple((n.y_val, n.tick) for n in env.Nodes))
+				if key not in adsr_fits:
+					envtable, loop_end = self.calc_env_table(env)
+					a, d_start = self.calc_attack(envtable, loop_end, tempo)
+					adsr_fits[key] = (a,) + self.calc_dsr(envtable, loop_end, d_start, tempo)
+				a, d, s, r, rr = adsr_fits[key]
+				#print('d, s, r, rr =', (d, s, r, rr))
+				
+				if a is None and d == 0x7 and s == 0x7 and r == 0x0:
+					flags_a = '00007F'
+				else:
+					if a is None:
+						a = 0xF
+					da = hex(d + 0x8)[2:].upper() + hex(a)[2:].upper()
+					sr = hex(s * 0x20 + r)[2:].zfill(2).upper()
+					flags_a = da + sr + '7F'
+					
+				if rr is not None and flags_r is None: # Override release flag
+					flags_r = flags_a[:2] + hex(s * 0x20 + rr)[2:].zfill(2).upper() + '7F'
+					
+		return flags_a, flags_r
+		
+	def get_release_ticks(self, release):
+		# Ticks until release (ADSR/gain bytes like the `r` flag) makes a note silent, or inf if it doesn't
+		da, sr, gain = int(release[:2], 16), int(release[2:4], 16), int(release[4:6], 16)
+		if da >= 0x80: # ADSR, which goes on from wherever the envelope is, so allow for the decay too
+			d, s, r = (da >> 4) & 0x7, sr >> 5, sr & 0x1F
+			return float('inf') if r == 0 else self.dsr_cache[(d, s, r)]
+		if gain < 0x80:
+			return float('inf') if gain > 0 else 0
+		mode, rate = (gain >> 5) & 0x3, gain & 0x1F
+		if mode > 1 or rate == 0: # Increasing, or not changing
+			return float('inf')
+		if mode == 0: # Linear decrease, 64 steps
+			return int(math.ceil(64 * self.adsr_rates[rate] * float(self.tempo) * 24 / 60.0 / 32000.0)) + 1
+		return self.sr_cache[(7, rate)] # Exponential decrease
+		
+class MMLState:
+	def __init__(self):
+		self.state_d = { 'o':None, 'h':0, 'v':None, 'q':None, \
+						'tune':0x00, 'y':(10, 0, 0), 'p':(0, 0, 0), 'trem':(0, 0, 0), \
+						'echo':0x00, '@':0, 'dgain':None, 'note':None, \
+						'echof':False, 'n':None, 'amp':0x00, 'gain':None }
+		self.hstate_d = { '':None, 'M':None, 'S':0x90, 'X':0x80, \
+						'E':0x00, 'H':0x00, 'I':0x00, 'J':0x00, \
+						'Q':0x00, 'R':0x00, 'v':None, '@':None, \
+						'IV':None, 'SV':None, 'EV':None, 'EX':None, 'EE':None, 'H':0x00,
+						'Z1':None }
+						
+class MML:
+	def __init__(self, event_table, config=None):
+		self.txt = ''
+		self.event_table = event_table
+		self.config = config if config is not None else event_table.config
+		self.states = [MMLState(), MMLState(), MMLState(), MMLState(), \
+						MMLState(), MMLState(), MMLState(), MMLState()]
+		self.g_state = { 'evoll':0, 'evolr':0 }
+		self.echo_set = False
+		
+		self.default_len = None
+		self.len_table = self.calc_len_table()
+		
+		self.add_amk_header()
+		self.add_spc_info()
+		adsr_gains = self.get_adsr_gains()
+		
+		# The channels don't need the tunings, so they're generated while the samples are still
+		# converting, and #samples and #instruments are put in front of them afterwards
+		header, self.txt = self.txt, ''
+		self.add_init_info()
+		self.convert()
+		body, self.txt = self.txt, header
+		self.add_sample_info()
+		self.add_ins_info(adsr_gains)
+		self.txt = ''.join((self.txt, body))
+		
+	def add_amk_header(self):
+		self.txt = ''.join(('#amk 2\n\n', self.txt))
+		
+	def add_spc_info(self):
+		spc_text = '#SPC\n{\n'
+		add_spc_header = False
+		
+		if self.event_table.module.SongName != '':
+			add_spc_header = True
+			title = self.event_table.module.SongName.replace('\r', '').replace('\n', ' ').replace('"', "'")
+			spc_text += '    #title   "' + title + '"\n'
+		if self.config.flag('game') != '':
+			add_spc_header = True
+			spc_text += '    #game    "' + self.config.flag('game').replace('\r', '').replace('\n', ' ').replace('"', "'") + '"\n'
+		if self.config.flag('author') != '':
+			add_spc_header = True
+			spc_text += '    #author  "' + self.config.flag('author').replace('\r', '').replace('\n', ' ').replace('"', "'") + '"\n'
+		if self.config.flag('length') != '':
+			add_spc_header = True
+			spc_text += '    #length  "' + self.config.flag('length').replace('\r', '').replace('\n', ' ').replace('"', "'") + '"\n'
+		if self.event_table.module.Message != '':
+			add_spc_header = True
+			msg = self.event_table.module.Message.replace('\r', '').replace('\n', ' ').replace('"', "'")
+			msg2 = ''
+			interpret = False
+			for c in msg:
+				if c == '`':
+					interpret = not interpret
+				elif not interpret:
+					msg2 = ''.join((msg2, c))
+			spc_text += '    #comment "' + msg2.strip() + '"\n'
+			
+		spc_text += '}\n\n'
+		
+		if add_spc_header:
+			self.txt = ''.join((self.txt, spc_text))
+			
+	def add_sample_info(self):
+		path = self.event_table.module_path.replace('\\', '/').split('/')[-1].split('.')[0]
+		sample_text = '#path ' + '"' + path + '"' + '\n\n' + '#samples\n{\n'
+		add_sample_header = False
+		
+		listed = set()
+		for k in self.event_table.sample_dict:
+			add_sample_header = True
+			sample_name = self.event_table.sample_dict[k][0]
+			if sample_name not in listed: # Duplicate samples share one BRR
+				listed.add(sample_name)
+				sample_text += '    ' + '"' + sample_name + '"' + '\n'
+			
+		sample_text += '}\n\n'
+		
+		if add_sample_header:
+			self.txt = ''.join((self.txt, sample_text))
+			
+	def get_adsr_gains(self):
+		# ADSR and gain bytes for every entry of ins_list
+		adsr_gains = []
+		for i in self.event_table.ins_list:
+			adsr = self.event_table.ins_adsr[i[0]][0].upper()
+			adsr_gains.append('$' + adsr[:2] + ' $' + adsr[2:4] + ' $' + adsr[4:6])
+		return adsr_gains
+		
+	def add_ins_info(self, adsr_gains):
 		ins_text = '#instruments\n{\n'
 		
 		#print(self.event_table.ins_dict)
 		#print(self.event_table.ins_list)
 		
-		tempo = self.event_table.module.IT
-		self.init_adsr_caches(tempo)
-		
-		for i in self.event_table.ins_list:
-			ins = i[0]
+		for i, adsr_gain in zip(self.event_table.ins_list, adsr_gains):
 			samp_name, samp_tuning = '', ''
 			
 			if i[1] > 0:
@@ -1314,41 +2118,6 @@ class MML:
 					break
 				samp_name = self.event_table.sample_dict[s][0]
 				samp_tuning = self.event_table.sample_dict[s][1]
-			
-			flags = self.event_table.get_ins_flags_ins(ins)
-			flags_a = flags['a']
-			adsr_gain = ''
-			
-			if flags_a is None:
-				if not self.event_table.module.Instruments[ins - 1].volEnv.IsOn:
-					flags_a = '00007F'
-				else:
-					a, d, s, r = 0xF, 0x7, 0x7, 0x0
-					envtable, loop_end = self.calc_env_table(self.event_table.module.Instruments[ins - 1].volEnv)
-					#print('ins', ins, 'envtable:', envtable)
-					a, d_start = self.calc_attack(envtable, loop_end, tempo)
-					d, s, r, rr = self.calc_dsr(envtable, loop_end, d_start, tempo)
-					#print('d, s, r, rr =', (d, s, r, rr))
-					
-					if a is None and d == 0x7 and s == 0x7 and r == 0x0:
-						flags_a = '00007F'
-					else:
-						if a is None:
-							a = 0xF
-						da = hex(d + 0x8)[2:].upper() + hex(a)[2:].upper()
-						sr = hex(s * 0x20 + r)[2:].upper()
-						flags_a = da + sr + '7F'
-						
-					if rr is not None and flags['r'] is None: # Override release flag
-						flags_r = flags_a[:2] + hex(s * 0x20 + rr)[2:].upper() + '7F'
-						#print('FLAGS_R', flags_r)
-						self.event_table.module.Instruments[ins - 1].InstName = '`r' + flags_r + '`' + self.event_table.module.Instruments[ins - 1].InstName
-						# ^ this is hacky as fuck but hey it works!
-
-			da = '$' + flags_a[:2].upper()
-			sr = '$' + flags_a[2:4].upper()
-			ga = '$' + flags_a[4:6].upper()
-			adsr_gain = da + ' ' + sr + ' ' + ga
 				
 			ins_text += '    ' + ('"' + samp_name + '"').ljust(32) + ' ' + adsr_gain + ' ' + samp_tuning + (' ; noise' if i[1] == 0 else '') + '\n'
 		
@@ -1359,23 +2128,23 @@ class MML:
 		init_text = ''
 		
 		init_text += 'w' + str(int(round(255 * math.sqrt(self.event_table.module.GV/128.0)))) + ' '
-		init_text += 't' + str(int(math.ceil(self.event_table.module.IT * 0.4096 * Config.flag('tmult')/2))) + '\n\n'
+		init_text += 't' + str(int(math.ceil(self.event_table.module.IT * 0.4096 * self.config.flag('tmult')/2))) + '\n\n'
 		
-		if Config.flag('echo') != '':
-			self.g_state['evoll'] = int(Config.flag('echo')[4:6], 16)
-			self.g_state['evolr'] = int(Config.flag('echo')[6:8], 16)
+		if self.config.flag('echo') != '':
+			self.g_state['evoll'] = int(self.config.flag('echo')[4:6], 16)
+			self.g_state['evolr'] = int(self.config.flag('echo')[6:8], 16)
 			
-			init_text += '$EF $00 $' + Config.flag('echo')[4:6].upper() + ' $' + Config.flag('echo')[6:8].upper() + '\n'
-			init_text += '$F1 $' + Config.flag('echo')[0:2].upper() + ' $' + Config.flag('echo')[2:4].upper() + ' $01\n\n'
-		if Config.flag('fir') != '':
+			init_text += '$EF $00 $' + self.config.flag('echo')[4:6].upper() + ' $' + self.config.flag('echo')[6:8].upper() + '\n'
+			init_text += '$F1 $' + self.config.flag('echo')[0:2].upper() + ' $' + self.config.flag('echo')[2:4].upper() + ' $01\n\n'
+		if self.config.flag('fir') != '':
 			init_text += '$F5'
 			for i in range(0, 8):
-				init_text += ' $' + Config.flag('fir')[2*i : 2*i + 2].upper()
+				init_text += ' $' + self.config.flag('fir')[2*i : 2*i + 2].upper()
 			init_text += '\n\n'
-		if Config.flag('master') != '':
-			init_text += '$F6 $0C $' + Config.flag('master')[0:2].upper() + '\n'
-			init_text += '$F6 $1C $' + Config.flag('master')[2:4].upper() + '\n\n'
-		if Config.flag('legato'):
+		if self.config.flag('master') != '':
+			init_text += '$F6 $0C $' + self.config.flag('master')[0:2].upper() + '\n'
+			init_text += '$F6 $1C $' + self.config.flag('master')[2:4].upper() + '\n\n'
+		if self.config.flag('legato'):
 			init_text += ('$F4 $02\n\n')
 		
 		if init_text != '':
@@ -1545,7 +2314,7 @@ class MML:
 		it_hf = it_h >> 4
 		it_ha = it_h & 0x0F
 		if it_hf > 0:
-			freq = max(min(int(round(256 / ((64 / it_hf) * Config.flag('tmult')))), 255), 0)
+			freq = max(min(int(round(256 / ((64 / it_hf) * self.config.flag('tmult')))), 255), 0)
 		amp = it_ha * 15
 		#if it_h != 0x00:
 		#	print('DJGFKDHG', (delay, freq, amp))
@@ -1563,7 +2332,7 @@ class MML:
 		if it_v is None or it_m is None or it_iv is None or it_sv is None:
 			return None, None
 		
-		linear_v = int(round(255 * norm * Config.flag('vmult') * (it_v/64.0) * (it_m/64.0) * (it_iv/128.0) * (it_sv/64.0)))
+		linear_v = int(round(255 * norm * self.config.flag('vmult') * (it_v/64.0) * (it_m/64.0) * (it_iv/128.0) * (it_sv/64.0)))
 		mml_v = self.find_v(min(linear_v, 255))
 		amp = 0x00
 		if linear_v > 255:
@@ -1590,62 +2359,23 @@ class MML:
 			return None, 1
 			
 		it_pan = (0xFF - min(max(it_x + 4 * (it_ex - 32) + pps_offset, 0), 0xFF))
-		base_pan = None
-		if Config.flag('panning') == 'linear':
-			base_pan = int(round(it_pan * 20.0/255.0))
-		elif Config.flag('panning') == 'accurate':
-			smw_pan_tbl = [0x00, 0x01, 0x03, 0x07, 0x0D, 0x15, 0x1E, 0x29, 0x34, 0x42,
-			               0x51, 0x5E, 0x67, 0x6E, 0x73, 0x77, 0x7A, 0x7C, 0x7D, 0x7E, 0x7F]
-			lvol = max(it_pan, 1) - 0x01
-			rvol = 0xFF - max(it_pan, 1)
-			
-			diff, basepan, rnorm = 1000000, 1.0, None
-			for p in range(len(smw_pan_tbl)):
-				plvol = smw_pan_tbl[p]
-				prvol = smw_pan_tbl[20 - p]
-				sum = plvol + prvol
-				norm = 254.0 / sum
-				
-				plvol *= norm
-				prvol *= norm
-				
-				tdiff = abs(plvol - lvol) + abs(prvol - rvol)
-				
-				if tdiff < diff:
-					base_pan = p
-					diff = tdiff
-					rnorm = norm
-					
-			#print('RNORM =', rnorm)
-			
+		
 		# TODO: Factor in pan-per-note and random pan variation
 		
 		flags = self.event_table.get_ins_flags_ins(it_ins)
+		surround = it_s is not None and it_s == 0x91
 		
-		if it_s is None or it_s != 0x91:
-			return (base_pan, 0, 0) if not flags['i'] else (base_pan, 1, 1), rnorm / 2.0
-		else:
-			return (10, 1, 0) if not flags['i'] else (10, 0, 1), 1
+		try:
+			return pan_tables[(self.config.flag('panning'), surround, flags['i'])][it_pan]
+		except KeyError:
+			raise CompileErrorException('Invalid panning mode "' + str(self.config.flag('panning')) + '".')
 		
 	def find_v(self, level):
 		if level == 0:
 			return 0
-	
-		mindiff = 256
-		minval = -1
-		
-		for v in range(0, 256):
-			vv = (v * 0xFF) >> 8
-			vv = (vv * vv) >> 8
-			vv = (vv * 0x51) >> 8
-			vv = (vv * 0xFC) >> 8
-			l = vv * 0xFF / 0x4D
-			
-			if abs(l - level) <= mindiff:
-				mindiff = abs(l - level)
-				minval = v
-
-		return minval
+		if isinstance(level, int) and level > 0 and level < len(v_table):
+			return v_table[level]
+		return search_v(level)
 		
 	def set_instrument(self, c, effect, value, ticklen):
 		self.states[c].hstate_d['@'] = value
@@ -1717,7 +2447,7 @@ class MML:
 		self.append('$FA $00 $' + hex(pmod_flags)[2:].upper().zfill(2), True)
 		
 	def set_mml_cmd(self, c, effect, value, ticklen, ticklen_max, it_tick):
-		#ticklen = int(Config.flag('tmult') * ticklen)
+		#ticklen = int(self.config.flag('tmult') * ticklen)
 		ret = ''
 	
 		if effect == 'patt' or effect == 'bar':
@@ -1745,16 +2475,16 @@ class MML:
 				self.set_prenote(c, value, it_tick, False)
 				#self.append('%R' + str(self.states[c].hstate_d['@']), True) # Custom release macro
 				#self.append('^' + self.tick_str(ticklen))
-				flags = self.event_table.get_ins_flags_ins(self.states[c].hstate_d['@'])
-				if flags['r'] is None:
+				release = self.event_table.get_ins_release(self.states[c].hstate_d['@'])
+				if release is None:
 					self.append('r' + self.tick_str(c, ticklen))
 				else:
 					self.states[c].state_d['@'] = None # Force redef of instrument next note to reset instrument adsr/gain
 					self.states[c].state_d['n'] = None
-					if int(flags['r'][:2], 16) < 0x80:
-						self.append('$FA $01 $' + flags['r'][4:6], True)
+					if int(release[:2], 16) < 0x80:
+						self.append('$FA $01 $' + release[4:6], True)
 					else:
-						self.append('$ED $' + hex(int(flags['r'][:2], 16) - 0x80)[2:].zfill(2).upper() + ' $' + flags['r'][2:4], True)
+						self.append('$ED $' + hex(int(release[:2], 16) - 0x80)[2:].zfill(2).upper() + ' $' + release[2:4], True)
 					self.append('^' + self.tick_str(c, ticklen))
 			elif value == 254: # Note cut
 				self.set_prenote(c, value, it_tick, False)
@@ -1767,7 +2497,7 @@ class MML:
 				
 				if flags['f'] is None:
 					fade = self.event_table.module.Instruments[ins - 1].FadeOut
-					ticks = int(round((1024 / fade) * Config.flag('tmult')))
+					ticks = int(round((1024 / fade) * self.config.flag('tmult')))
 					#print('TICKLENS:', ticklen, ticklen_max)
 					if ticks > ticklen_max:
 						fadelevel = int(round(self.states[c].state_d['v'] * (1 - ticklen_max / ticks) + 0x10 * (ticklen_max / ticks)))
@@ -1806,7 +2536,7 @@ class MML:
 			
 		if effect != '':
 			if effect == 'T':
-				self.append('t' + str(int(math.ceil(value * 0.4096 * Config.flag('tmult')/2))), True)
+				self.append('t' + str(int(math.ceil(value * 0.4096 * self.config.flag('tmult')/2))), True)
 			elif effect == 'V':
 				self.append('w' + str(int(round(255 * math.sqrt(value/128.0)))), True)
 			elif effect == 'mml':
@@ -1823,12 +2553,47 @@ class MML:
 			else:
 				self.append(ret)
 				
+	def calc_len_table(self):
+		# Shortest length string for every tick length up to a dotted whole note. If one row at the initial
+		# speed is a standard note length, it becomes the l default and is written without a number.
+		table = []
+		for ticklen in range(0, max(note_lengths) + 1):
+			table.append(self.tick_str_ticks(ticklen))
+			
+		if self.config.flag('notelen'):
+			row_len = int(self.event_table.module.IS * self.config.flag('tmult'))
+			if row_len in note_lengths:
+				self.default_len = note_lengths[row_len]
+				
+			for ticklen in range(1, len(table)):
+				if ticklen == row_len and self.default_len is not None:
+					table[ticklen] = ''
+					continue
+				if ticklen in note_lengths and len(note_lengths[ticklen]) <= len(table[ticklen]):
+					table[ticklen] = note_lengths[ticklen]
+				for part in note_lengths: # Tie a note length to a shorter string we've already found
+					if part < ticklen:
+						txt = table[part] + '^' + table[ticklen - part]
+						if len(txt) < len(table[ticklen]):
+							table[ticklen] = txt
+							
+		return table
+		
 	def tick_str(self, c, ticklen):
+		if self.config.flag('notelen'):
+			txt = ''
+			while ticklen >= len(self.len_table):
+				ticklen -= 192
+				txt += note_lengths[192] + '^'
+			return txt + self.len_table[ticklen]
+		return self.tick_str_ticks(ticklen, c)
+		
+	def tick_str_ticks(self, ticklen, c=None):
 		txt = ''
 		while ticklen > 127:
 			ticklen -= 127
 			txt += '=127^'
-		if self.states[c].state_d['n'] is not None:
+		if c is not None and self.states[c].state_d['n'] is not None:
 			#txt += '=' + str(ticklen - 1) + 'q7F ^=1' #TODO: repeat whatever the hell q actually is
 			txt += '=' + str(ticklen)
 		else:
@@ -1836,24 +2601,61 @@ class MML:
 		return txt
 		
 	def convert(self):
+		# Channels only share read-only event table data, so they can be generated separately and joined in order.
+		# The one piece of shared state is echo_set, which only channel 0 reads and writes.
+		jobs = min(self.config.flag('cjobs'), 8)
+		if jobs <= 1:
+			results = [self.convert_channel(c) for c in range(0, 8)]
+		else:
+			with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_mml_worker, initargs=(self,),
+			                                            mp_context=process_context()) as executor:
+				results = list(executor.map(convert_mml_channel, range(0, 8)))
+				
 		for c in range(0, 8):
-			self.append('#' + str(c) + '  ')
-			for e in range(0, len(self.event_table.events[c]) - 1):
-				event = self.event_table.events[c][e]
-				next = self.event_table.events[c][e + 1]
-				next2 = self.event_table.events[c][e + 1]
-				i = 0
-				while e + 1 + i < len(self.event_table.events[c]) and (self.event_table.events[c][e + 1 + i].effect == 'patt' or self.event_table.events[c][e + 1 + i].effect == 'bar'):
-					next2 = self.event_table.events[c][e + 1 + i]
-					i += 1
-				ticklen = int(Config.flag('tmult') * next.tick) - int(Config.flag('tmult') * event.tick)
-				ticklen2 = int(Config.flag('tmult') * next2.tick) - int(Config.flag('tmult') * event.tick)
-				self.set_mml_cmd(c, event.effect, event.value, ticklen, ticklen2, event.tick)
-			self.append('\n\n')
+			txt, self.states[c], echo_set = results[c]
+			if c == 0:
+				self.echo_set = echo_set
+			self.append(txt)
+			
+	def convert_channel(self, c):
+		# Returns the MML text for channel c, its final state and echo_set
+		txt, self.txt = self.txt, ''
+		
+		tmult = self.config.flag('tmult')
+		self.append('#' + str(c) + '  ')
+		if self.default_len is not None:
+			self.append('l' + self.default_len, True)
+		events = self.event_table.events[c]
+		ticks = [int(tmult * event.tick) for event in events]
+		
+		# run_end[e] is e, or the last event of the run of patt/bar markers starting at e
+		run_end = list(range(len(events)))
+		for e in range(len(events) - 2, -1, -1):
+			if events[e].effect in ('patt', 'bar') and events[e + 1].effect in ('patt', 'bar'):
+				run_end[e] = run_end[e + 1]
+				
+		for e in range(0, len(events) - 1):
+			event = events[e]
+			ticklen = ticks[e + 1] - ticks[e]
+			ticklen2 = ticks[run_end[e + 1]] - ticks[e]
+			self.set_mml_cmd(c, event.effect, event.value, ticklen, ticklen2, event.tick)
+		self.append('\n\n')
+		
+		txt, self.txt = self.txt, txt
+		return txt, self.states[c], self.echo_set
 		
 	def save(self, filename):
 		with open(filename, 'w') as file:
 			file.write(self.txt)
 
+worker_mml = None
+
+def init_mml_worker(mml):
+	global worker_mml
+	worker_mml = mml
+	
+def convert_mml_channel(c):
+	return worker_mml.convert_channel(c)
+
 if __name__ == "__main__":
 	main()
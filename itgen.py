@@ -0,0 +1,278 @@
+"""
+Synthetic IT module generator for load and scaling tests.
+
+    python itgen.py <output.it> [--seed n] [--patterns n] [--rows n] [--channels n] ...
+
+takes any of the write_module() arguments as --name value pairs. Everything comes from the seed, so the
+same arguments always give the same file. Patterns and sample data are written as they're generated,
+so modules of hundreds of MB don't have to fit in memory; the output only has to be seekable, since
+the offset tables are filled in at the end.
+"""
+
+import os
+import random
+import struct
+import sys
+
+import numpy as np
+
+commands = [
+	(1, lambda rng: rng.randrange(2, 9)),							# Axx
+	(4, lambda rng: rng.choice((0x01, 0x0F, 0x10, 0xF0, 0x00))),	# Dxy
+	(5, lambda rng: rng.randrange(1, 0x20)),						# Exx
+	(6, lambda rng: rng.randrange(1, 0x20)),						# Fxx
+	(7, lambda rng: rng.randrange(1, 0x40)),						# Gxx
+	(8, lambda rng: rng.randrange(0x11, 0x88)),						# Hxy
+	(13, lambda rng: rng.randrange(0, 65)),							# Mxx
+	(20, lambda rng: rng.randrange(0x60, 0xC0)),					# Txx
+	(24, lambda rng: rng.randrange(0, 256))							# Xxx
+]
+
+def write_module(path, seed=0, patterns=8, rows=64, channels=8, orders=0, notes=0.4, effects=0.3, loops=0.0,
+                 instruments=8, nodes=0, sample_length=4096, sample_bits=16, compressed=False, it215=False, sample_loops=True, flags=''):
+	"""
+	Write a random module to path. There are patterns patterns of rows rows with notes on the first
+	channels channels, played by an order list of orders entries (0 = each pattern once) that goes
+	through the patterns in turn. notes and effects are the chances of a cell having a note and an
+	effect. loops is the chance of a pattern having an SBx loop and a pattern break or order jump.
+	Every instrument plays its own sample of sample_length 8 or 16-bit frames, IT 2.14 (or with it215,
+	2.15) compressed if compressed is set, looped over its last three quarters unless sample_loops is
+	False, and has a volume envelope of nodes points (0 = none). flags
+	are it2amk flags like '-t 3 -vm 1.2' put in the song message.
+
+	Effects and note offs only go on channels that already had a note in the same or an earlier
+	pattern, so the order list should play the patterns in ascending order (it does by default).
+	Raises ValueError if an argument is out of range or a pattern packs to more than IT's 64 KB, in
+	which case nothing is left at path.
+	"""
+	if not 1 <= patterns <= 200 or not 1 <= rows <= 200 or not 1 <= channels <= 64 or not 1 <= instruments <= 99:
+		raise ValueError('Patterns, rows, channels or instruments out of range.')
+	if not 0 <= nodes <= 25 or nodes == 1 or sample_bits not in (8, 16) or sample_length < 1:
+		raise ValueError('Envelope nodes or sample format out of range.')
+	if not 0 <= orders <= 255:
+		raise ValueError('Orders out of range.')
+
+	rng = random.Random(seed)
+	order_list = [o % patterns for o in range(orders if orders > 0 else patterns)] + [255]
+	message = ('Generated by itgen.py with seed ' + str(seed) + ('\r`' + flags + '`' if flags else '')).encode('utf-8') + b'\0'
+
+	try:
+		with open(path, 'wb') as out:
+			# Header, with the offset tables filled in at the end
+			out.write(struct.pack('<4s26sBB', b'IMPM', ('itgen ' + str(seed)).encode('utf-8')[:25].ljust(26, b'\0'), 4, 16))
+			out.write(struct.pack('<HHHHHHHH', len(order_list), instruments, instruments, patterns, 0x0214,
+			                      0x0215 if compressed and it215 else 0x0214, 0x000D, 0x0007))
+			msg_offs = 192 + len(order_list) + 8 * instruments + 4 * patterns
+			out.write(struct.pack('<BBBBBBHII', 128, 48, 6, 125, 128, 0, len(message), msg_offs, 0))
+			out.write(bytes([32] * 64))
+			out.write(bytes([64] * 64))
+			out.write(bytes(order_list))
+			out.write(bytes(8 * instruments + 4 * patterns))
+			out.write(message)
+
+			ins_offs = []
+			for i in range(instruments):
+				ins_offs.append(out.tell())
+				out.write(pack_instrument(rng, i + 1, nodes))
+
+			smp_offs = []
+			for i in range(instruments):
+				smp_offs.append(out.tell())
+				out.write(pack_sample_header(rng, i + 1, sample_length, sample_bits, compressed, it215, sample_loops))
+
+			first_pos = {}
+			for pos, p in enumerate(order_list[:-1]):
+				first_pos.setdefault(p, pos)
+			ptn_offs = []
+			played = set() # Channels with an instrument, where note offs, cuts and effects are safe
+			for p in range(patterns):
+				cells = generate_pattern(rng, rows, channels, instruments, notes, effects, played)
+				if rng.random() < loops:
+					cells[0][0] = cells[0][0][:3] + (19, 0xB0)						# SB0
+					cells[rows // 2][0] = cells[rows // 2][0][:3] + (19, 0xB2)		# SB2
+					if rows > 8 and rng.random() < 0.5:
+						cells[rows - 8][min(1, channels - 1)] = cells[rows - 8][min(1, channels - 1)][:3] + (3, rng.randrange(0, 8))	# Cxx
+					elif p in first_pos and first_pos[p] + 2 < len(order_list) - 1:
+						cells[rows - 1][min(2, channels - 1)] = cells[rows - 1][min(2, channels - 1)][:3] + (2, first_pos[p] + 2)	# Bxx
+				ptn_offs.append(out.tell())
+				data = pack_pattern(cells)
+				if len(data) > 0xFFFF:
+					raise ValueError('Pattern ' + str(p) + ' packs to ' + str(len(data)) + ' bytes, more than IT\'s 65535; use fewer rows, channels, notes or effects.')
+				out.write(struct.pack('<HH4x', len(data), rows))
+				out.write(data)
+				del cells, data
+
+			data_offs = []
+			for i in range(instruments):
+				data_offs.append(out.tell())
+				write_sample_data(out, np.random.default_rng(rng.randrange(1 << 32)), sample_length, sample_bits, compressed, it215)
+
+			out.seek(192 + len(order_list))
+			out.write(struct.pack('<' + str(2 * instruments + patterns) + 'I', *(ins_offs + smp_offs + ptn_offs)))
+			for s, offs in zip(smp_offs, data_offs):
+				out.seek(s + 72)
+				out.write(struct.pack('<I', offs))
+	except ValueError:
+		os.remove(path) # Don't leave half a module behind
+		raise
+
+def pack_envelope(flags=0, nodes=(), sustain=0):
+	# nodes is a list of (y, tick); 82 bytes
+	data = struct.pack('<BBBBBB', flags, len(nodes), 0, max(len(nodes) - 1, 0), sustain, sustain)
+	for i in range(25):
+		data += struct.pack('<bH', *(nodes[i] if i < len(nodes) else (0, 0)))
+	return data + b'\0'
+
+def pack_instrument(rng, s, nodes):
+	# An instrument playing sample s on every note, with a random volume envelope
+	data = struct.pack('<4s12sBBBBHBBBBBBHBB', b'IMPI', b'', 0, 0, 0, 0, rng.randrange(0, 256), 0, 0x3C, 128, 128, 0, 0, 0x0214, 1, 0)
+	data += ('stress ' + str(s)).encode('utf-8').ljust(26, b'\0')
+	data += struct.pack('<BBBBH', 0, 0, 0, 0, 0)
+	data += b''.join(struct.pack('<BB', n, s) for n in range(120))
+	if nodes > 0:
+		env = []
+		tick = 0
+		for i in range(nodes):
+			env.append((64 if i == 0 else rng.randrange(0, 65), tick))
+			tick += rng.randrange(1, 40)
+		sustain = rng.random() < 0.5 # Sustain loop on one node
+		data += pack_envelope(0x05 if sustain else 0x01, env, rng.randrange(1, nodes) if sustain else 0)
+	else:
+		data += pack_envelope()
+	return data + pack_envelope() + pack_envelope() + b'\0' * 4
+
+def pack_sample_header(rng, s, length, bits, compressed, it215, looped=True):
+	flags = 0x01 | (0x10 if looped else 0) | (0x02 if bits == 16 else 0) | (0x08 if compressed else 0)
+	cvt = 0x01 | (0x04 if compressed and it215 else 0)
+	return struct.pack('<4s12sBBBB26sBBIIIIIIIBBBB', b'IMPS', b'', 0, 64, flags, 64, ('stress ' + str(s)).encode('utf-8'), cvt, 0,
+	                   length, length // 4, length, rng.choice((8363, 16000, 22050, 32000)), 0, 0, 0, 0, 0, 0, 0)
+
+def generate_pattern(rng, rows, channels, instruments, notes, effects, played):
+	# rows lists of channels cells of (note, instrument, volume, effect, effect value), with None for
+	# what's empty
+	cells = []
+	for r in range(rows):
+		row = []
+		for c in range(channels):
+			note = ins = vol = effect = arg = None
+			if rng.random() < notes:
+				note, ins = rng.randrange(36, 96), rng.randrange(1, instruments + 1)
+				played.add(c)
+			elif c in played and rng.random() < 0.05:
+				note = rng.choice((254, 255))
+			if rng.random() < 0.3:
+				vol = rng.randrange(0, 65)
+			if c in played and rng.random() < effects:
+				effect, arg = rng.choice(commands)
+				arg = arg(rng)
+			row.append((note, ins, vol, effect, arg))
+		cells.append(row)
+	return cells
+
+def pack_pattern(cells):
+	# IT pattern data, leaving out repeated masks and values like trackers do
+	out = bytearray()
+	last_mask = [None] * 64
+	last = [[None, None, None, None] for c in range(64)]
+	for row in cells:
+		for c, (note, ins, vol, effect, arg) in enumerate(row):
+			mask = 0
+			data = bytearray()
+			for i, (value, bit) in enumerate(((note, 1), (ins, 2), (vol, 4), ((effect, arg) if effect is not None else None, 8))):
+				if value is None:
+					continue
+				if value == last[c][i]:
+					mask |= bit << 4
+				else:
+					mask |= bit
+					last[c][i] = value
+					data += bytes(value) if isinstance(value, tuple) else bytes((value,))
+			if mask == 0:
+				continue
+			if mask == last_mask[c]:
+				out.append(c + 1)
+			else:
+				out += bytes(((c + 1) | 128, mask))
+				last_mask[c] = mask
+			out += data
+		out.append(0)
+	return bytes(out)
+
+def write_sample_data(out, rng, length, bits, compressed, it215):
+	# A few sines and some noise, written one compression block at a time
+	block = 0x4000 if bits == 16 else 0x8000
+	f1, f2 = rng.uniform(0.01, 0.2), rng.uniform(0.2, 0.9)
+	scale = 1 if bits == 16 else 1.0 / 256
+	for start in range(0, length, block):
+		t = np.arange(start, min(start + block, length))
+		data = np.sin(t * f1) * 12000 + np.sin(t * f2) * 4000 + rng.normal(0, 500, len(t))
+		data = np.clip(np.round(data * scale), -(1 << (bits - 1)), (1 << (bits - 1)) - 1).astype(np.int64)
+		if compressed:
+			out.write(compress_block(data, bits, it215))
+		else:
+			out.write(data.astype('<i2' if bits == 16 else 'i1').tobytes())
+
+def compress_block(data, bits, it215):
+	"""
+	One IT compressed block: a length word and a bit stream of deltas (of deltas with it215). The
+	stream switches once from the starting width (bits + 1) to the narrowest width all the deltas fit
+	in, which isn't the best compression but is quick and valid.
+	"""
+	mask = (1 << bits) - 1
+	deltas = np.diff(data, prepend=0)
+	if it215:
+		deltas = np.diff(deltas, prepend=0)
+	deltas = ((deltas + (1 << (bits - 1))) & mask) - (1 << (bits - 1)) # Wrapped like the decoder's integrators
+	lo, hi = int(deltas.min()), int(deltas.max())
+
+	width = bits + 1
+	for w in range(1, bits + 1):
+		# Widths under 7 reserve their lowest value, and wider ones the 16 values around the wrap,
+		# for switching widths
+		if w < 7:
+			fits = -(1 << (w - 1)) < lo and hi < (1 << (w - 1))
+		else:
+			border = (1 << (w - 1)) - (4 if bits == 8 else 8)
+			fits = -border <= lo and hi < border
+		if fits:
+			width = w
+			break
+
+	values = [np.array([(1 << bits) | (width - 1)], dtype=np.int64)] if width <= bits else []
+	values.append(deltas & ((1 << min(width, bits)) - 1))
+	widths = [bits + 1] * (len(values) - 1) + [width]
+	stream = np.concatenate([((v[:, None] >> np.arange(w)) & 1).ravel() for v, w in zip(values, widths)]).astype(np.uint8)
+	packed = np.packbits(stream, bitorder='little').tobytes()
+	return struct.pack('<H', len(packed)) + packed
+
+def main():
+	args = sys.argv[1:]
+	defaults = write_module.__defaults__
+	names = write_module.__code__.co_varnames[1:1 + len(defaults)]
+	if len(args) % 2 != 1 or any(not a.startswith('--') or a[2:] not in names for a in args[1::2]):
+		print('Usage: python itgen.py <output.it> [--' + ' n] [--'.join(names) + ' n]')
+		sys.exit(1)
+
+	options = {}
+	for i in range(1, len(args), 2):
+		name, value = args[i][2:], args[i + 1]
+		default = defaults[names.index(name)]
+		try:
+			if isinstance(default, bool):
+				if value.lower() not in ('true', 'false'):
+					raise ValueError
+				options[name] = value.lower() == 'true'
+			else:
+				options[name] = type(default)(value)
+		except ValueError:
+			print('Error: --' + name + ' must be ' + ('true or false.' if isinstance(default, bool) else 'a ' + type(default).__name__ + '.'))
+			sys.exit(1)
+
+	try:
+		write_module(args[0], **options)
+	except ValueError as e:
+		print('Error: ' + str(e))
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,130 @@
+"""
+Per-stage timing for a conversion. Stages are existing functions and methods, which are wrapped only
+while a Profiler is hooked in, so nothing is measured (or slowed down) otherwise.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+class Stage:
+	def __init__(self, name):
+		self.name = name
+		self.calls = 0
+		self.wall = 0.0
+		self.cpu = 0.0
+		self.peak = 0
+
+class Profiler:
+	def __init__(self, memory=False):
+		self.memory = memory
+		self.stages = {}
+		self.hooks = []
+		self.active = threading.local() # Stages being timed in each thread, for not counting recursion twice
+		self.lock = threading.Lock()
+		self.open = [] # Highest traced memory so far in each stage call that's running, in any thread
+		self.wall = 0.0
+		self.cpu = 0.0
+		self.peak = 0
+
+	def hook(self, stages):
+		# stages is a list of (class or module, attribute name, stage name)
+		for owner, attr, name in stages:
+			self.stages.setdefault(name, Stage(name))
+			original = getattr(owner, attr)
+			setattr(owner, attr, self.wrap(original, name))
+			self.hooks.append((owner, attr, original))
+
+	def unhook(self):
+		for owner, attr, original in reversed(self.hooks):
+			setattr(owner, attr, original)
+		self.hooks = []
+
+	def wrap(self, fn, name):
+		@functools.wraps(fn)
+		def wrapper(*args, **kwargs):
+			active = getattr(self.active, 'names', None)
+			if active is None:
+				active = self.active.names = set()
+			if name in active:
+				return fn(*args, **kwargs)
+
+			active.add(name)
+			if self.memory:
+				with self.lock:
+					peak = [tracemalloc.get_traced_memory()[0]]
+					self.update_peaks()
+					tracemalloc.reset_peak()
+					self.open.append(peak)
+			wall, cpu = time.perf_counter(), time.thread_time()
+			try:
+				return fn(*args, **kwargs)
+			finally:
+				wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+				active.discard(name)
+				with self.lock:
+					stage = self.stages[name]
+					stage.calls += 1
+					stage.wall += wall
+					stage.cpu += cpu
+					if self.memory:
+						self.update_peaks()
+						self.open = [p for p in self.open if p is not peak]
+						stage.peak = max(stage.peak, peak[0])
+		return wrapper
+		
+	def update_peaks(self):
+		# tracemalloc has one peak for everything, so it's folded into the running stages before
+		# it's reset for a new one
+		traced = tracemalloc.get_traced_memory()[1]
+		for peak in self.open:
+			peak[0] = max(peak[0], traced)
+		self.peak = max(self.peak, traced)
+
+	def run(self, fn):
+		# Runs fn() and records the totals. With memory on, a stage's peak is the most memory traced
+		# during any of its calls.
+		if self.memory:
+			tracemalloc.start()
+			self.peak = 0
+		wall, cpu, children = time.perf_counter(), time.process_time(), sum(os.times()[2:4])
+		try:
+			return fn()
+		finally:
+			self.wall = time.perf_counter() - wall
+			self.cpu = time.process_time() - cpu + sum(os.times()[2:4]) - children
+			if self.memory:
+				self.update_peaks()
+				tracemalloc.stop()
+
+	def format_table(self):
+		lines = ['Stage                       Calls   Wall (s)    CPU (s)' + ('   Peak (MB)' if self.memory else '')]
+		for stage in self.stages.values():
+			line = '%-26s %6d %10.3f %10.3f' % (stage.name, stage.calls, stage.wall, stage.cpu)
+			lines.append(line + ('%12.1f' % (stage.peak / 1048576.0) if self.memory else ''))
+		line = '%-26s %6s %10.3f %10.3f' % ('total', '', self.wall, self.cpu)
+		lines.append(line + ('%12.1f' % (self.peak / 1048576.0) if self.memory else ''))
+		lines.append('Stages can contain each other and overlap, so they don\'t add up to the total. CPU time of a stage only')
+		lines.append('counts its own thread; the total includes sample conversion processes.')
+		return '\n'.join(lines)
+
+	def report(self):
+		stages = []
+		for stage in self.stages.values():
+			s = { 'name' : stage.name, 'calls' : stage.calls, 'wall' : stage.wall, 'cpu' : stage.cpu }
+			if self.memory:
+				s['peak_memory'] = stage.peak
+			stages.append(s)
+		report = { 'wall' : self.wall, 'cpu' : self.cpu, 'stages' : stages }
+		if self.memory:
+			report['peak_memory'] = self.peak
+		return report
+
+	def save(self, filename, **extra):
+		report = self.report()
+		report.update(extra)
+		with open(filename, 'w') as file:
+			json.dump(report, file, indent=4)
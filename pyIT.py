@@ -29,7 +29,6 @@ import os.path
 import sys
 import struct
 from io import BytesIO
-import traceback
 import logging
 
 #import psyco
@@ -231,6 +230,7 @@ class ITsample(object):
         # length is determined by sample data
         # note, lengths and loop indices are in SAMPLES, not BYTES
         
+        self.Length = 0 # from the header; sampleDataLen() is what was actually read
         self.LoopBegin = 0
         self.LoopEnd = 0
         self.C5Speed = 8363
@@ -351,6 +351,7 @@ class ITsample(object):
         self.IT215Compression = self.IsCompressed and bool(self.Cvt & 0x04)
         
         (length, self.LoopBegin, self.LoopEnd, self.C5Speed) = struct.unpack('<IIII', inf.read(16))
+        self.Length = length
         (self.SusLoopBegin, self.SusLoopEnd, offs_sampledata, self.ViS,
          self.ViD, self.ViT, self.ViR) = struct.unpack('<IIIBBBB', inf.read(16))
         
@@ -368,7 +369,7 @@ class ITsample(object):
                 log.debug("     compressed!")
                 
                 # real sample decompression
-                decompressedbuf = StringIO()
+                decompressedbuf = BytesIO()
                 
                 if self.Is16bit:
                     decompressor = pyitcompress.it_decompress16
@@ -401,8 +402,7 @@ class ITsample(object):
                     self._original_sample_data = self.SampleData
                     
                 except:
-                    print()
-                    traceback.print_exc()
+                    log.debug("     couldn't decompress the sample", exc_info=True)
             else:
                 # Load uncompressed sample
                 length = length * mult
@@ -703,8 +703,12 @@ class ITfile(object):
         self.Patterns = []
 
     def open(self, infilename):
-        log = logging.getLogger("pyIT.ITfile.open")
-        inf = open(infilename, "rb")
+        with open(infilename, "rb") as inf:
+            self.load(inf)
+        
+    def load(self, inf):
+        # inf is any seekable binary file object, e.g. io.BytesIO for a module already in memory
+        log = logging.getLogger("pyIT.ITfile.load")
         
         buf = inf.read(30)
         (IMPM, self.SongName) = struct.unpack('<4s26s', buf)
@@ -814,8 +818,6 @@ class ITfile(object):
                 pass
             self.Samples.append(samp)
         
-        inf.close()
-        
     def write(self, outfilename):
         log = logging.getLogger("pyIT.ITfile.write")
         outf = open(outfilename, "wb")
@@ -197,7 +197,7 @@ def it_decompress8(dest, len, srcbuf, it215):
             d2 = (d2 + d1) & 0xff
             
             # .. and store it into the buffer
-            dest.write(chr(d2) if it215 else chr(d1))
+            dest.write(bytes((d2 if it215 else d1,)))
             blkpos += 1
 
         # now subtract block length from total length and go on
@@ -293,8 +293,7 @@ def it_decompress16(dest, len, srcbuf, it215):
             
             # .. and store it into the buffer
             outval = d2 if it215 else d1
-            dest.write(chr(outval & 0xff))
-            dest.write(chr(unsignbyte(outval >> 8)))
+            dest.write(bytes((outval & 0xff, unsignbyte(outval >> 8))))
             blkpos += 1
 
         # now subtract block length from total length and go on
@@ -0,0 +1,229 @@
+"""
+Port of the SampConv resamplers (SampConv/IT2AMK/Conv/resampler.cs).
+
+Resampling also takes care of lining a sample up for BRR: looped samples get a loop length and
+loop start that are multiples of 16 (by stretching or repeating the loop), and every sample gets
+a length that is a multiple of 16.
+
+Every output point is computed at once with array operations, in chunks so that resamplers with
+many taps (sinc) don't need an (outputs x taps) array for the whole sample.
+"""
+
+import math
+
+import numpy as np
+
+class Resampler:
+	taps = [0]
+	chunk_size = 1 << 20 # Most outputs * taps handled in one go
+
+	def resample(self, sample, new_length):
+		assert new_length > 0
+
+		sample.trim()
+		sample.expand_ping_loop()
+		new_sample = sample.copy()
+		new_sample.clear_sample_data()
+
+		if not sample.looped or sample.loop_start >= sample.loop_end:
+			self._resample_unlooped(sample, new_sample, new_length)
+		else:
+			self._resample_looped(sample, new_sample, new_length)
+
+		return new_sample
+
+	def _steppers(self, start, multiplier, end):
+		# Same values as repeatedly doing stepper += multiplier while stepper < end
+		count = int(math.ceil((end - start) / multiplier)) + 2
+		steppers = np.cumsum(np.concatenate(([start], np.full(count, multiplier))))
+		return steppers[steppers < end]
+
+	def _chunks(self, count):
+		step = max(1, self.chunk_size // len(self.taps))
+		return [(i, min(i + step, count)) for i in range(0, count, step)]
+
+	def _resample_unlooped(self, sample, new_sample, new_length):
+		multiplier = sample.length / new_length
+
+		steppers = self._steppers(0.0, multiplier, sample.length)
+		floors = np.floor(steppers).astype(np.int64)
+		fracs = steppers - floors
+
+		data = []
+		for a, b in self._chunks(len(steppers)):
+			indexes = np.minimum(np.add.outer(floors[a:b], self.taps), sample.length - 1)
+			data.append(self._interpolate(sample, fracs[a:b], indexes))
+		data = np.concatenate(data)
+		new_sample.c5_speed = int(sample.c5_speed / multiplier)
+
+		pad = (16 - len(data) % 16) % 16 # Pad zeros at end to multiple of 16 length
+		new_sample.set_sample_data(np.concatenate((data, np.zeros((pad, data.shape[1]), dtype=np.int64))))
+
+	def _resample_looped(self, sample, new_sample, new_length):
+		multiplier, offset, new_length, repeats = loop_alignment(sample.length, sample.loop_start, sample.loop_end, new_length)
+		for i in range(0, repeats):
+			sample.set_sample_data(np.concatenate((sample.data, sample.data[sample.loop_start:])), keep_loop=True)
+
+		steppers = self._steppers(offset, multiplier, sample.length)
+		floors = np.floor(steppers).astype(np.int64)
+
+		loop_len = sample.length - sample.loop_start
+		fracs = steppers - floors
+
+		data = []
+		for a, b in self._chunks(len(steppers)):
+			indexes = np.add.outer(floors[a:b], self.taps)
+			over = indexes >= sample.length
+			indexes[over] = sample.loop_start + (indexes[over] - sample.loop_start) % loop_len
+			indexes_l = np.where((floors[a:b, None] >= sample.loop_start) & (indexes < sample.loop_start), indexes + loop_len, indexes)
+
+			sp = self._interpolate(sample, fracs[a:b], indexes)
+			sp2 = self._interpolate(sample, fracs[a:b], indexes_l)
+			data.append(np.floor((sp + sp2) / 2.0 + 0.5).astype(np.int64))
+		new_sample.set_sample_data(np.concatenate(data))
+
+		new_sample.loop_start = int(math.ceil(sample.loop_start / multiplier))
+		new_sample.loop_end = int(math.ceil(new_length))
+		new_sample.c5_speed = int(sample.c5_speed / multiplier)
+
+		new_sample.trim()
+		new_sample.pad_left() # Pad zeros at start to multiple of 16 length
+
+	def _points(self, sample, indexes):
+		# (points, taps, channels) array of sample values at indexes
+		return sample.data[np.maximum(indexes, 0)].astype(np.float64)
+
+	def _interpolate(self, sample, fracs, indexes):
+		raise NotImplementedError
+
+class NearestNeighborResampler(Resampler):
+	taps = [0, 1]
+
+	def _interpolate(self, sample, fracs, indexes):
+		p = self._points(sample, indexes)
+		return np.where(fracs[:, None] < 0.5, p[:, 0], p[:, 1]).astype(np.int64)
+
+class LinearResampler(Resampler):
+	taps = [0, 1]
+
+	def _interpolate(self, sample, fracs, indexes):
+		p = self._points(sample, indexes)
+		u = fracs[:, None]
+		return np.floor((1 - u) * p[:, 0] + u * p[:, 1] + 0.5).astype(np.int64)
+
+class CubicResampler(Resampler):
+	taps = [-1, 0, 1, 2]
+
+	def _interpolate(self, sample, fracs, indexes):
+		p = self._points(sample, indexes)
+		u = fracs[:, None]
+		value = ((u*u*(2-u)-u)*p[:, 0] + (u*u*(3*u-5)+2)*p[:, 1] + (u*u*(4-3*u)+u)*p[:, 2] + u*u*(u-1)*p[:, 3])/2 + 0.5
+		return np.floor(value).astype(np.int64)
+
+class SincResampler(Resampler):
+	# Kernel tables by (points, distinct fractions). A fixed ratio only visits a few fractions, so a
+	# table of them (the polyphase filter bank) serves every chunk and every sample at that ratio.
+	kernel_cache = {}
+	kernel_cache_size = 16
+	max_cached_phases = 4096
+
+	def __init__(self, sinc_points=512):
+		assert sinc_points > 0
+		self.taps = list(range(-(sinc_points // 2), sinc_points // 2))
+
+	def _kernel(self, fracs):
+		# (table, rows): table has one row of weights per distinct fraction, rows picks each output's row
+		phases, rows = np.unique(fracs, return_inverse=True)
+		if len(phases) > SincResampler.max_cached_phases:
+			return np.sinc(np.subtract.outer(phases, self.taps)), rows
+
+		key = (len(self.taps), phases.tobytes())
+		table = SincResampler.kernel_cache.get(key)
+		if table is None:
+			if len(SincResampler.kernel_cache) >= SincResampler.kernel_cache_size:
+				SincResampler.kernel_cache.clear()
+			table = np.sinc(np.subtract.outer(phases, self.taps))
+			SincResampler.kernel_cache[key] = table
+		return table, rows
+
+	def _interpolate(self, sample, fracs, indexes):
+		# Points before the start count as silence; past the end they wrap into the loop
+		valid = indexes >= 0
+		if sample.looped and sample.loop_start < sample.length:
+			loop_len = sample.length - sample.loop_start
+			over = indexes >= sample.length
+			indexes = np.where(over, sample.loop_start + (indexes - sample.loop_start) % loop_len, indexes)
+		else:
+			valid &= indexes < sample.length
+
+		table, rows = self._kernel(fracs)
+		p = self._points(sample, np.where(valid, indexes, 0)) * valid[:, :, None]
+		return np.floor(np.einsum('nt,ntc->nc', table[rows], p) + 0.5).astype(np.int64)
+
+resamplers = {
+	'nearest' : NearestNeighborResampler,
+	'linear' : LinearResampler,
+	'cubic' : CubicResampler,
+	'sinc' : SincResampler
+}
+
+def loop_alignment(length, loop_start, loop_end, new_length):
+	"""
+	How a looped sample of length frames gets resampled to about new_length frames with a loop length
+	that's a multiple of 16, by stretching the loop or repeating it, whichever comes out shorter.
+	Returns (multiplier, offset, new length, times the loop is repeated); only needs the lengths, so
+	output sizes can be worked out without resampling anything.
+	"""
+	multiplier = length / new_length
+	diff = (loop_end - loop_start) / multiplier
+	offset = 0.0
+
+	if diff != math.floor(diff):
+		new_length *= math.ceil(diff) / diff
+		multiplier = length / new_length
+		offset = (math.ceil(new_length) - new_length) * -multiplier
+
+	loop_length = int(math.ceil(diff))
+
+	# First calculate how long the sample would be if we stretched it to match %16==0
+	stretch_length = new_length
+	if loop_length % 16 != 0:
+		stretch_loop_length = loop_length + 16 - loop_length % 16
+		stretch_length *= stretch_loop_length / loop_length
+
+	# Then calculate how long the sample would be if we instead repeated the looped portion to match %16==0
+	repeat_length = new_length
+	repeat_loop_length = loop_length
+	repeats = 0
+	while repeat_loop_length % 16 != 0:
+		repeat_loop_length += loop_length
+		repeat_length += loop_length
+		repeats += 1
+
+	# If the repeated case is shorter, then let's repeat the looped part
+	if repeat_length < stretch_length and repeat_length != new_length:
+		multiplier = length / new_length
+		offset = (math.ceil(new_length) - new_length) * -multiplier
+		return multiplier, offset, repeat_length, repeats
+	elif stretch_length != new_length:
+		new_length = stretch_length
+		multiplier = length / new_length
+		offset = (math.ceil(new_length) - new_length) * -multiplier
+	return multiplier, offset, new_length, 0
+
+def resampled_length(length, loop_start, new_length):
+	"""
+	(length, loop start) of what Resampler.resample() makes of a trimmed sample of length frames,
+	with loop_start None if it isn't looped. The length can come out a block longer than the real one.
+	"""
+	if loop_start is None or loop_start >= length:
+		# One more frame than there are steppers, in case rounding adds one at the end
+		new_length = int(math.floor(new_length)) + 1
+		return new_length + (16 - new_length % 16) % 16, None
+	multiplier, offset, new_length, repeats = loop_alignment(length, loop_start, length, new_length)
+	new_length = int(math.ceil(new_length)) # The steppers reach it and trim() cuts off the rest
+	pad = (16 - new_length % 16) % 16
+	return new_length + pad, int(math.ceil(loop_start / multiplier)) + pad
+
+def get_resampler(name):
+	return resamplers[name]()
@@ -0,0 +1,317 @@
+"""
+In-process sample conversion, replacing sampconv.exe and brr_encoder.exe.
+
+Follows the same steps as SampConv: trim, expand ping-pong loops, amplify, resample (which also
+lines loops up to 16 samples), encode to BRR and write the AMK loop header. Tunings are returned
+directly instead of going through temp/tunings.txt.
+"""
+
+import concurrent.futures
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+import brr
+import resampler
+
+encoder_version = 2 # Bump when conversion output changes, so older cached BRRs aren't reused
+
+invalid_filename_chars = '"<>|:*?\\/' + ''.join(chr(i) for i in range(0, 32))
+
+class SampleError(Exception):
+	pass
+
+class Sample:
+	# Sample data is an int64 (length, channels) array. Loop points behave like SampConv's: they are
+	# clamped to the sample length and the loop start never goes past the loop end.
+	def __init__(self):
+		self.data = np.zeros((0, 1), dtype=np.int64)
+		self.name = ''
+		self.looped = False
+		self.ping_looped = False
+		self.c5_speed = 8363
+		self._loop_start = 0
+		self._loop_end = 0
+
+	@staticmethod
+	def from_it(it_sample):
+		sample = Sample()
+		sample.name = it_sample.SampleName.rstrip(' ')
+		sample.looped = it_sample.IsLooped
+		sample.ping_looped = it_sample.IsPingPongLoop
+		sample.c5_speed = it_sample.C5Speed
+
+		raw = it_sample.SampleData if it_sample.IsSample else b''
+		if it_sample.IsCompressed and len(raw) == 0:
+			raise SampleError('Sample "' + sample.name + '" is compressed and could not be decompressed.')
+		signed = (it_sample.Cvt & 0x01) != 0
+		if it_sample.Is16bit:
+			data = np.frombuffer(raw, dtype='<i2' if signed else '<u2', count=len(raw) // 2).astype(np.int64)
+			if not signed:
+				data -= 0x8000
+		else:
+			data = np.frombuffer(raw, dtype=np.int8 if signed else np.uint8).astype(np.int64)
+			if not signed:
+				data -= 0x80
+			data *= 0x100
+		if it_sample.IsStereo:
+			data = data[:len(data) // 2 * 2].reshape(2, -1).T
+		else:
+			data = data.reshape(-1, 1)
+		if len(data) == 0:
+			data = np.zeros((16, 1), dtype=np.int64) # Empty samples become one silent block
+		sample.data = np.ascontiguousarray(data)
+
+		sample._loop_start = it_sample.LoopBegin
+		sample._loop_end = it_sample.LoopEnd
+		if sample.looped and not (sample.loop_start < sample.loop_end <= sample.length):
+			sample.looped, sample.ping_looped = False, False # Broken loops are ignored by trackers too
+		return sample
+
+	def copy(self):
+		sample = Sample()
+		sample.data = self.data.copy()
+		sample.name = self.name
+		sample.looped = self.looped
+		sample.ping_looped = self.ping_looped
+		sample.c5_speed = self.c5_speed
+		sample._loop_start = self._loop_start
+		sample._loop_end = self._loop_end
+		return sample
+
+	@property
+	def length(self):
+		return len(self.data)
+
+	@property
+	def loop_start(self):
+		return self._loop_start
+
+	@loop_start.setter
+	def loop_start(self, value):
+		self._loop_start = min(max(value, 0), self.length)
+		if self._loop_start > self._loop_end:
+			self._loop_end = self._loop_start
+
+	@property
+	def loop_end(self):
+		return self._loop_end
+
+	@loop_end.setter
+	def loop_end(self, value):
+		self._loop_end = min(max(value, 0), self.length)
+		if self._loop_start > self._loop_end:
+			self._loop_start = self._loop_end
+
+	def clear_sample_data(self):
+		self.data = np.zeros((0, self.data.shape[1]), dtype=np.int64)
+		self._loop_start = 0
+		self._loop_end = 0
+
+	def set_sample_data(self, data, keep_loop=False):
+		self.data = data
+		if not keep_loop:
+			self._loop_start = min(self._loop_start, self.length)
+			self._loop_end = min(self._loop_end, self.length)
+
+	def trim(self):
+		if self.looped:
+			self.data = self.data[:self.loop_end]
+
+	def expand_ping_loop(self):
+		if self.ping_looped:
+			self.trim()
+			self.ping_looped = False
+			if self.loop_end - 2 > self.loop_start:
+				self.data = np.concatenate((self.data, self.data[self.loop_end - 2:self.loop_start:-1]))
+			self._loop_end = self.length
+
+	def truncate(self, length):
+		# Drop everything from length on, unless the loop starts before it and keeps the rest playing
+		if length >= self.length or (self.looped and length >= self.loop_start):
+			return
+		self.looped, self.ping_looped = False, False
+		self.set_sample_data(self.data[:length])
+
+	def amplify(self, ratio):
+		self.data = np.floor(self.data * ratio + 0.5).astype(np.int64)
+
+	def pad_left(self):
+		# Pad with 0s at the beginning until total length%16==0
+		if self.length % 16 != 0:
+			pad = 16 - self.length % 16
+			self.data = np.concatenate((np.zeros((pad, self.data.shape[1]), dtype=np.int64), self.data))
+			self.loop_end = self.length
+			self.loop_start = self.loop_start + pad
+
+	def fix_clipping(self):
+		peak = int(np.abs(self.data).max()) if self.length > 0 else 0
+		if peak > 0x7FFF:
+			self.data = np.floor(self.data * (0x7FFF / peak) + 0.5).astype(np.int64)
+
+	def mono(self):
+		# 16-bit mono PCM, averaging stereo channels towards zero like SampConv
+		if self.data.shape[1] == 1:
+			return self.data[:, 0].copy()
+		total = self.data[:, 0] + self.data[:, 1]
+		return np.where(total < 0, -((-total) // 2), total // 2)
+
+class PreparedSample:
+	# A sample ready to be written to the samples folder. Cache hits have BRR data but no sample.
+	# Duplicates of an earlier sample share its BRR file.
+	def __init__(self, index, name, tuning, fingerprint, brr_data=None, sample=None):
+		self.index = index
+		self.name = name
+		self.tuning = tuning
+		self.fingerprint = fingerprint
+		self.brr_data = brr_data
+		self.sample = sample
+		self.shared = None # The PreparedSample whose BRR this one uses
+
+	@property
+	def filename(self):
+		if self.shared is not None:
+			return self.shared.filename
+		return brr_filename(self.index, self.name)
+
+	@property
+	def size(self):
+		# BRR file size, projected from the sample length if it hasn't been encoded
+		if self.shared is not None:
+			return self.shared.size
+		elif self.brr_data is not None:
+			return len(self.brr_data)
+		return 2 + brr.brr_size(self.sample.length, brr.initial_block_needed(self.sample.mono()[:brr.BLOCK_SAMPLES]))
+
+	def read_brr(self):
+		if self.shared is not None:
+			return self.shared.read_brr()
+		return self.brr_data
+
+def format_filename(filename):
+	return ''.join(c for c in filename if c not in invalid_filename_chars)
+
+def brr_filename(index, name):
+	return str(index).zfill(2) + ' ' + format_filename(name) + '.brr'
+
+def calc_tuning(c5_speed):
+	# AMK tuning bytes, as '$XX $YY'
+	tuning = hex(int(np.floor(c5_speed * 768 / 12539 + 0.5)))[2:].upper().zfill(4)
+	return '$' + tuning[:2] + ' $' + tuning[2:]
+
+def prepare_sample(sample, resample_ratio, amplify_ratio, interpolation='cubic', max_length=None):
+	# Trim, expand ping loops, truncate, amplify and resample, with loop start and length at multiples of 16
+	sample = sample.copy()
+	sample.trim()
+	sample.expand_ping_loop()
+	if max_length is not None:
+		sample.truncate(max_length)
+	sample.amplify(amplify_ratio)
+	sample = resampler.get_resampler(interpolation).resample(sample, sample.length * resample_ratio)
+
+	if sample.length % 16 != 0 or sample.loop_start % 16 != 0:
+		sample = resampler.get_resampler(interpolation).resample(sample, sample.length)
+	sample.trim()
+	sample.fix_clipping()
+	return sample
+
+def fingerprint(sample):
+	# Samples with the same fingerprint encode to the same BRR
+	h = hashlib.sha256(repr((sample.looped, sample.loop_start if sample.looped else 0, sample.length)).encode('utf-8'))
+	h.update(sample.mono().astype('<i8').tobytes())
+	return h.hexdigest()
+
+def sample_to_brr(sample, beam=1, fast=False):
+	# BRR file contents: the AMK loop pointer followed by the BRR blocks
+	pcm = [int(s) for s in sample.mono()]
+	brr_data, loop_block = brr.encode(pcm, sample.loop_start if sample.looped else None, beam, fast)
+	loop_ptr = brr.BLOCK_BYTES * loop_block if loop_block is not None else 0
+	return struct.pack('<H', loop_ptr) + brr_data
+
+def prepare_it_sample(index, it_sample, resample_ratio, amplify_ratio, interpolation, max_length):
+	sample = prepare_sample(Sample.from_it(it_sample), resample_ratio, amplify_ratio, interpolation, max_length)
+	return PreparedSample(index, sample.name, calc_tuning(sample.c5_speed), fingerprint(sample), sample=sample)
+
+def run_jobs(executor, fn, args, size):
+	# fn(*a) for every a in args, in order. With an executor the biggest jobs (by size(a)) are
+	# submitted first, so one big sample doesn't hold up the end of the pool.
+	if executor is None:
+		return [fn(*a) for a in args]
+	futures = {}
+	for i in sorted(range(0, len(args)), key=lambda i: -size(args[i])):
+		futures[i] = executor.submit(fn, *args[i])
+	return [futures[i].result() for i in range(0, len(args))]
+
+def share_duplicates(prepared):
+	# Point every sample at the first sample with the same fingerprint
+	first = {}
+	for p in prepared:
+		if p.fingerprint in first:
+			p.shared = first[p.fingerprint]
+		else:
+			first[p.fingerprint] = p
+
+def convert_samples(module, used_samples, resample_ratios, amplify_ratios, encode=True, beam=1, jobs=1, cache=None,
+                    interpolation='cubic', max_lengths=None, fast=False, mp_context=None):
+	"""
+	Convert the used samples (1-based sample numbers) of a pyIT module. Ratios and max_lengths
+	(frames to truncate to, None to keep everything) are lists indexed by sample number - 1.
+	interpolation names the resampler, and beam and fast are brr.encode()'s. With jobs > 1 the
+	samples are converted in that many processes (0 = one per CPU core), started with the
+	multiprocessing context mp_context, which shouldn't fork if other threads are running. Samples
+	found in cache (a BRRCache) aren't converted, and newly encoded ones are added to it. Samples that
+	come out identical after resampling are encoded once and share a BRR. Returns PreparedSamples in
+	sample order.
+	"""
+	used = sorted(used_samples)
+	args = [(s, module.Samples[s - 1], resample_ratios[s - 1], amplify_ratios[s - 1], interpolation,
+	         max_lengths[s - 1] if max_lengths else None) for s in used]
+
+	results = {}
+	keys = {}
+	if cache is not None:
+		for a in args:
+			keys[a[0]] = cache.key(a[1], (encoder_version, float(a[2]), float(a[3]), interpolation, a[5], beam, fast))
+			hit = cache.get(keys[a[0]])
+			if hit is not None:
+				results[a[0]] = PreparedSample(a[0], a[1].SampleName.rstrip(' '), hit[1], hit[2], brr_data=hit[0])
+	misses = [a for a in args if a[0] not in results]
+
+	jobs = min(jobs if jobs > 0 else (os.cpu_count() or 1), len(misses))
+	executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context) if jobs > 1 else None
+	try:
+		for p in run_jobs(executor, prepare_it_sample, misses, lambda a: len(a[1].SampleData)):
+			results[p.index] = p
+		prepared = [results[s] for s in used]
+		share_duplicates(prepared)
+
+		if encode:
+			unique = [p for p in prepared if p.sample is not None and p.shared is None]
+			brr_data = run_jobs(executor, sample_to_brr, [(p.sample, beam, fast) for p in unique], lambda a: a[0].length)
+			for p, data in zip(unique, brr_data):
+				p.brr_data = data
+	finally:
+		if executor is not None:
+			executor.shutdown()
+
+	if cache is not None and encode:
+		for a in misses:
+			p = results[a[0]]
+			cache.put(keys[a[0]], p.read_brr(), p.tuning, p.fingerprint)
+	return prepared
+
+def write_samples(folder, prepared):
+	# Clear the song's samples folder and write the BRRs into it
+	if not os.path.isdir(folder):
+		os.makedirs(folder)
+	else:
+		for f in os.listdir(folder):
+			if os.path.isfile(os.path.join(folder, f)):
+				os.remove(os.path.join(folder, f))
+
+	for p in prepared:
+		if p.shared is None:
+			with open(os.path.join(folder, p.filename), 'wb') as file:
+				file.write(p.brr_data)